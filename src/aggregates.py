@@ -0,0 +1,98 @@
+"""
+Local store of daily line list aggregates
+
+Each build stores case counts by country, status, gender and age bucket
+of the snapshot it reports on, keyed by the snapshot's archive URL, so
+later reports can compare against it without reading the snapshot again.
+The store is kept next to the archive cache, so it persists with it.
+"""
+import os
+import sqlite3
+import datetime
+from pathlib import Path
+from typing import Optional
+from contextlib import closing
+
+import pandas as pd
+
+import cache
+
+AGGREGATES_FILE = Path(
+    os.getenv("MONKEYPOX_AGGREGATES", cache.CACHE_PATH / "aggregates.sqlite")
+)
+COLUMNS = ["Country", "Status", "Gender", "Age_bucket", "n"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counts (
+    file TEXT NOT NULL,
+    date TEXT NOT NULL,
+    country TEXT NOT NULL,
+    status TEXT NOT NULL,
+    gender TEXT NOT NULL,  -- empty if unknown
+    age_bucket INTEGER NOT NULL,  -- -1 if unknown
+    n INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS counts_file ON counts (file);
+CREATE INDEX IF NOT EXISTS counts_date ON counts (date);
+"""
+
+
+def connect() -> sqlite3.Connection:
+    AGGREGATES_FILE.parent.mkdir(parents=True, exist_ok=True)
+    # backfill workers write concurrently, waiting for each other's writes
+    db = sqlite3.connect(AGGREGATES_FILE, timeout=60)
+    db.executescript(SCHEMA)
+    return db
+
+
+def save(file: str, date: datetime.date, counts: pd.DataFrame):
+    """Stores counts of the snapshot at file URL, with data up to date,
+    replacing counts stored earlier for the same file
+
+    counts: Dataframe with COLUMNS, as returned by build.daily_counts()
+    """
+    with closing(connect()) as db, db:
+        db.execute("DELETE FROM counts WHERE file = ?", (file,))
+        db.executemany(
+            "INSERT INTO counts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (file, date.isoformat(), str(c), str(s), str(g), int(a), int(n))
+                for c, s, g, a, n in counts[COLUMNS].itertuples(index=False)
+            ),
+        )
+
+
+def load(file: str) -> Optional[pd.DataFrame]:
+    "Returns counts stored for the snapshot at file URL, None if not stored"
+    with closing(connect()) as db:
+        counts = pd.read_sql_query(
+            "SELECT country, status, gender, age_bucket, n FROM counts WHERE file = ?",
+            db,
+            params=(file,),
+        )
+    if counts.empty:
+        return None
+    return counts.set_axis(COLUMNS, axis=1)
+
+
+def history(status: str = "confirmed") -> pd.DataFrame:
+    """Returns number of cases with status by date and country
+
+    For each date, the counts of the last stored snapshot are used.
+    """
+    with closing(connect()) as db:
+        counts = pd.read_sql_query(
+            """WITH latest AS (SELECT date, MAX(file) AS file FROM counts GROUP BY date)
+            SELECT date, country, SUM(n) AS n FROM counts JOIN latest USING (date, file)
+            WHERE status = ?
+            GROUP BY date, country""",
+            db,
+            params=(status,),
+        )
+    return (
+        counts.assign(date=pd.to_datetime(counts.date))
+        .pivot(index="date", columns="country", values="n")
+        .fillna(0)
+        .astype(int)
+        .rename_axis(index="Date", columns="Country")
+    )
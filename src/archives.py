@@ -1,17 +1,31 @@
 """
 Create archives list for Monkeypox reports
+
+A summary of every published report is kept in a manifest in the bucket
+(MANIFEST_KEY), so each deploy only reads the manifest and the new report,
+and rewrites it with the new report appended. Use --rebuild to recreate the
+manifest from every report in the bucket.
 """
 import os
 import json
+import time
 import logging
+import argparse
+import datetime
 from typing import Any
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import chevron
 
 BUCKET = os.getenv("WEBSITE_BUCKET", "www.monkeypox.global.health")
 TEMPLATE = Path(__file__).parent / "archives.html"
+ARCHIVE_PREFIX = "20"  # year, date folders are named YYYY-MM-DD
+FETCH_WORKERS = 16
+PROGRESS_EVERY = 100
+MANIFEST_KEY = "archives/manifest.json"
+ARCHIVE_FIELDS = ["date", "n_confirmed", "n_suspected"]
 
 
 s3 = boto3.resource("s3")
@@ -27,34 +41,109 @@ def keep(dictionary, keys: list[str]):
     return {k: dictionary[k] for k in keys}
 
 
-def fetch_list(bucket_name: str) -> list[dict[str, Any]]:
+def list_indices(bucket_name: str, prefix: str = ARCHIVE_PREFIX) -> list[str]:
+    """Return keys of index.json in date folders, latest first
+
+    Only the top level folders starting with prefix are listed, not the
+    figures and assets within them.
+    """
+    paginator = s3.meta.client.get_paginator("list_objects_v2")
+    folders = [
+        p["Prefix"]
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/")
+        for p in page.get("CommonPrefixes", [])
+    ]
+    return sorted((f"{folder}index.json" for folder in folders), reverse=True)
+
+
+def fetch_list(
+    bucket_name: str, workers: int = FETCH_WORKERS
+) -> dict[str, list[dict[str, Any]]]:
     "Fetch indices list as index.json from S3 bucket"
     logging.info(f"Fetching list of indices from bucket {bucket_name}")
-    bucket = s3.Bucket(bucket_name)
+    start = time.perf_counter()
     try:
-        indices = sorted(
-            [
-                obj
-                for obj in bucket.objects.all()
-                if obj.key.endswith("index.json") and obj.key.startswith("20")  # year
-            ],
-            key=lambda obj: obj.key,
-            reverse=True,
-        )
+        keys = list_indices(bucket_name)
     except Exception:
         logging.error("Error in fetching list of archives")
         raise
+    logging.info(
+        f"Found {len(keys)} archives in {time.perf_counter() - start:.1f}s, fetching"
+    )
+
+    # resources are not thread-safe, but their client is
+    client = s3.meta.client
+
+    def fetch(key: str) -> dict[str, Any] | None:
+        try:
+            body = client.get_object(Bucket=bucket_name, Key=key)["Body"]
+        except client.exceptions.NoSuchKey:
+            logging.warning(f"Skipping archive without index.json: {key}")
+            return None
+        return keep(json.load(body), ARCHIVE_FIELDS)
+
+    archives = []
+    with ThreadPoolExecutor(workers) as executor:
+        for i, archive in enumerate(executor.map(fetch, keys), start=1):
+            if archive is not None:
+                archives.append(archive)
+            if i % PROGRESS_EVERY == 0:
+                logging.info(f"Fetched {i}/{len(keys)} archives")
+    logging.info(
+        f"Fetched {len(archives)} archives in {time.perf_counter() - start:.1f}s"
+    )
+    return {"archives": archives}
+
+
+def read_manifest(bucket_name: str) -> dict[str, list[dict[str, Any]]] | None:
+    "Return archives list from manifest, None if there is no manifest"
+    try:
+        return read_object(s3.Object(bucket_name, MANIFEST_KEY))
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+
+
+def write_manifest(bucket_name: str, archive_data: dict[str, list[dict[str, Any]]]):
+    "Write archives list to manifest"
+    logging.info(f"Writing {len(archive_data['archives'])} archives to manifest")
+    s3.Object(bucket_name, MANIFEST_KEY).put(
+        Body=json.dumps(archive_data, separators=(",", ":")),
+        ContentType="application/json",
+    )
+
+
+def append_manifest(
+    archive_data: dict[str, list[dict[str, Any]]], archive: dict[str, Any]
+) -> dict[str, list[dict[str, Any]]]:
+    "Return archives list with archive added, replacing one with the same date"
     return {
-        "archives": [
-            keep(
-                read_object(obj),
-                ["date", "n_confirmed", "n_suspected"],
-            )
-            for obj in indices
-        ]
+        "archives": sorted(
+            [a for a in archive_data["archives"] if a["date"] != archive["date"]]
+            + [keep(archive, ARCHIVE_FIELDS)],
+            key=lambda a: a["date"],
+            reverse=True,
+        )
     }
 
 
+def update_manifest(
+    bucket_name: str, date: str, rebuild: bool = False
+) -> dict[str, list[dict[str, Any]]]:
+    """Add report for date to the manifest and return archives list
+
+    The manifest is rebuilt from every report in the bucket if rebuild is
+    set or there is no manifest yet.
+    """
+    if not rebuild and (archive_data := read_manifest(bucket_name)) is not None:
+        archive_data = append_manifest(
+            archive_data, read_object(s3.Object(bucket_name, f"{date}/index.json"))
+        )
+    else:
+        archive_data = fetch_list(bucket_name)
+    write_manifest(bucket_name, archive_data)
+    return archive_data
+
+
 def render_archives(archive_data: dict[str, Any], template: Path) -> str:
     "Render archives data from template"
     with template.open() as f:
@@ -72,5 +161,18 @@ def upload(bucket: str, body: str):
 
 
 if __name__ == "__main__":
-    archives_data = fetch_list(BUCKET)
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--date",
+        help="Date of report to add to archives (default: today)",
+        default=datetime.date.today().isoformat(),
+    )
+    parser.add_argument(
+        "--rebuild",
+        help="Rebuild manifest from all reports in the bucket",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    archives_data = update_manifest(BUCKET, args.date, args.rebuild)
     upload(BUCKET, render_archives(archives_data, TEMPLATE))
@@ -0,0 +1,284 @@
+"""
+Benchmark report metrics and figures on synthetic line lists
+
+Line lists matching the archive schema are generated from a seed, so runs
+at the same size are comparable between commits. Each benchmark is timed
+and its peak memory allocation measured, and results are written as JSON.
+With --baseline, benchmarks slower than the baseline by more than the
+threshold are reported and the run fails:
+
+    python src/benchmark.py --rows 100000 --output benchmark.json
+    python src/benchmark.py --rows 100000 --baseline benchmark.json
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import platform
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Final
+
+import numpy as np
+import pandas as pd
+
+import build
+import choropleth
+import country_names
+from figures import genomics
+
+DEFAULT_ROWS: Final = 10_000
+DEFAULT_THRESHOLD: Final = 0.2  # fraction slower than baseline
+MIN_SECONDS: Final = 0.05  # differences below this are noise
+START_DATE: Final = datetime.date(2022, 5, 1)
+REPORT_DATE: Final = datetime.date(2022, 8, 1)
+
+STATUSES: Final = ["confirmed", "suspected", "discarded", "omit_error"]
+STATUS_WEIGHTS: Final = [0.75, 0.15, 0.09, 0.01]
+GENDERS: Final = ["male", "female", "other"]
+GENDER_WEIGHTS: Final = [0.6, 0.05, 0.01, 0.34]  # last is missing
+AGES: Final = ["20-29", "30-39", "40-49", "18-65", "35", "42", "<40", "0-4", None]
+AGE_WEIGHTS: Final = [0.15, 0.2, 0.1, 0.05, 0.1, 0.1, 0.05, 0.01, 0.24]
+CLADES: Final = ["B.1", "A.2", "A.1", "A"]
+CLADE_WEIGHTS: Final = [0.9, 0.02, 0.05, 0.03]
+
+
+def generate_line_list(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Returns synthetic line list with the archive schema
+
+    Status, Country and Gender are categoricals and Date_* columns are
+    parsed, as returned by build.read_snapshot(). Cases are ordered by
+    entry date, and about 10% of confirmed cases have a travel history.
+    """
+    rng = np.random.default_rng(seed)
+    # countries that can be drawn on the map
+    iso3 = np.array([c for c in choropleth.centroids.index if c in country_names.NAMES])
+    # a few countries report most cases
+    weights = 1 / np.arange(1, len(iso3) + 1) ** 1.5
+    country_iso3 = iso3[
+        rng.choice(len(iso3), rows, p=weights / weights.sum()).astype(np.int32)
+    ]
+    status = rng.choice(len(STATUSES), rows, p=STATUS_WEIGHTS)
+    entry = pd.Timestamp(START_DATE) + pd.to_timedelta(
+        np.sort(rng.integers(0, (REPORT_DATE - START_DATE).days, rows)), unit="D"
+    )
+    confirmation = entry + pd.to_timedelta(rng.integers(-2, 10, rows), unit="D")
+    travelled = (rng.random(rows) < 0.1) & (status == 0)
+    n_travelled = int(travelled.sum())
+    names = np.array([country_names.NAMES[c] for c in iso3], dtype=object)
+    travel_country = names[
+        rng.choice(len(iso3), n_travelled, p=weights / weights.sum())
+    ]
+    via = rng.random(n_travelled) < 0.1
+    travel_country[via] += "; " + names[rng.choice(len(iso3), int(via.sum()))]
+
+    df = pd.DataFrame(
+        {
+            "ID": pd.Series(np.arange(1, rows + 1)).astype(str).radd("N"),
+            "Status": pd.Categorical.from_codes(status, STATUSES),
+            "Country": pd.Categorical(pd.Series(country_iso3).map(country_names.NAMES)),
+            "Country_ISO3": country_iso3,
+            "Age": np.array(AGES, dtype=object)[
+                rng.choice(len(AGES), rows, p=AGE_WEIGHTS)
+            ],
+            "Gender": pd.Categorical.from_codes(
+                rng.choice(
+                    np.arange(-1, len(GENDERS)), rows, p=np.roll(GENDER_WEIGHTS, 1)
+                ),
+                GENDERS,
+            ),
+            "Date_onset": entry - pd.to_timedelta(rng.integers(0, 14, rows), unit="D"),
+            "Date_confirmation": confirmation.where(status == 0, pd.NaT),
+            "Date_entry": entry,
+            "Travel_history (Y/N/NA)": np.where(travelled, "Y", None),
+            "Travel_history_entry": None,
+            "Travel_history_location": None,
+            "Travel_history_country": None,
+        }
+    )
+    df.loc[travelled, "Travel_history_country"] = travel_country
+    df.loc[travelled, "Travel_history_entry"] = (
+        entry[travelled] - pd.to_timedelta(rng.integers(1, 30, n_travelled), unit="D")
+    ).strftime("%Y-%m-%d")
+    df.loc[travelled, "Travel_history_location"] = np.where(
+        rng.random(n_travelled) < 0.5, "Capital city", None
+    )
+    return df
+
+
+def previous_line_list(df: pd.DataFrame, days: int = 1, seed: int = 0) -> pd.DataFrame:
+    """Returns line list as it was days earlier
+
+    Cases entered in the last days are removed, and some confirmed cases
+    were still suspected.
+    """
+    rng = np.random.default_rng(seed)
+    cutoff = df.Date_entry.max() - pd.Timedelta(days=days - 1)
+    prev = df[df.Date_entry < cutoff].copy()
+    recently_confirmed = (prev.Status == "confirmed") & (
+        prev.Date_confirmation >= cutoff - pd.Timedelta(days=days)
+    )
+    prev.loc[recently_confirmed & (rng.random(len(prev)) < 0.5), "Status"] = "suspected"
+    return prev.reset_index(drop=True)
+
+
+def generate_genome_data(rows: int, seed: int = 0) -> pd.DataFrame:
+    "Returns synthetic Nextstrain metadata, as returned by build.read_nextstrain()"
+    rng = np.random.default_rng(seed)
+    names = np.array(list(country_names.NAMES.values()), dtype=object)
+    return pd.DataFrame(
+        {
+            "country": pd.Categorical(names[rng.integers(0, 60, rows)]),
+            "date": (
+                pd.Timestamp(START_DATE)
+                + pd.to_timedelta(rng.integers(0, 90, rows), unit="D")
+            ).strftime("%Y-%m-%d"),
+            "clade_membership": pd.Categorical.from_codes(
+                rng.choice(len(CLADES), rows, p=CLADE_WEIGHTS), CLADES
+            ),
+            "host": pd.Categorical(["Homo sapiens"] * rows),
+        }
+    )
+
+
+def benchmarks(
+    df: pd.DataFrame,
+    prev_df: pd.DataFrame,
+    last_week_df: pd.DataFrame,
+    genome_data: pd.DataFrame,
+) -> dict[str, Callable[[], Any]]:
+    "Returns benchmarks of report metrics and figures by name"
+    change_set = build.changes(df, prev_df)
+    return {
+        "build.CaseSummary": lambda: build.CaseSummary(df),
+        "build.counts_nextstrain": lambda: build.counts_nextstrain(genome_data),
+        "build.table_confirmed_cases": lambda: build.table_confirmed_cases(
+            df, last_week_df
+        ),
+        "build.n_cases": lambda: build.n_cases(df, "confirmed"),
+        "build.n_countries": lambda: build.n_countries(df, "suspected", only=True),
+        "build.travel_history_counts": lambda: build.travel_history_counts(df),
+        "build.changes": lambda: build.changes(df, prev_df),
+        "build.status_transitions": lambda: build.status_transitions(change_set),
+        "build.counts": lambda: build.counts(df, prev_df),
+        "build.travel_history": lambda: build.travel_history(df),
+        "build.demographics": lambda: build.demographics(df),
+        "build.age_gender": lambda: build.age_gender(df),
+        "build.delay_suspected_to_confirmed": lambda: build.delay_suspected_to_confirmed(
+            df
+        ),
+        "build.report_variables": lambda: build.report_variables(
+            REPORT_DATE, df, prev_df, last_week_df, genome_data
+        ),
+        "choropleth.counts": lambda: choropleth.counts(df),
+        "choropleth.cumulative_countries": lambda: choropleth.cumulative_countries(df),
+        "choropleth.cumulative_counts": lambda: choropleth.cumulative_counts(df),
+        "choropleth.travel_history": lambda: choropleth.travel_history(df),
+        "choropleth.figure": lambda: choropleth.figure(df),
+        "choropleth.figure_counts": lambda: choropleth.figure_counts(df),
+        "genomics.aggregate": lambda: genomics.aggregate(df, genome_data),
+    }
+
+
+def measure(benchmark: Callable[[], Any], repeat: int = 3) -> dict[str, float]:
+    """Returns fastest wall time in seconds of repeat runs, and peak memory
+    allocated in bytes, measured in a separate run as tracing slows it down"""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        benchmark()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        benchmark()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(min(seconds), 6), "peak_bytes": peak}
+
+
+def run(
+    rows: int = DEFAULT_ROWS,
+    seed: int = 0,
+    repeat: int = 3,
+    only: list[str] = [],
+) -> dict[str, Any]:
+    """Runs benchmarks on a synthetic line list of rows cases
+
+    only: Names of benchmarks to run, all if empty
+    """
+    logging.info(f"Generating line lists with {rows} rows")
+    df = generate_line_list(rows, seed)
+    prev_df = previous_line_list(df, 1, seed)
+    last_week_df = previous_line_list(df, 7, seed)
+    genome_data = generate_genome_data(max(rows // 10, 100), seed)
+    results = {}
+    for name, benchmark in benchmarks(df, prev_df, last_week_df, genome_data).items():
+        if only and name not in only:
+            continue
+        logging.info(f"Running {name}")
+        results[name] = measure(benchmark, repeat)
+    return {
+        "rows": rows,
+        "seed": seed,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "results": results,
+    }
+
+
+def regressions(
+    baseline: dict[str, Any],
+    current: dict[str, Any],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> list[str]:
+    """Returns descriptions of benchmarks slower than baseline by more than
+    threshold, ignoring differences below MIN_SECONDS"""
+    if baseline["rows"] != current["rows"]:
+        raise ValueError(
+            f"Baseline has {baseline['rows']} rows, current has {current['rows']}"
+        )
+    slower = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["seconds"], result["seconds"]
+        if after > before * (1 + threshold) and after - before > MIN_SECONDS:
+            slower.append(f"{name}: {before:.3f}s -> {after:.3f}s")
+    return slower
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Benchmark report metrics and figures on synthetic line lists"
+    )
+    parser.add_argument(
+        "--rows", help="Number of cases", type=int, default=DEFAULT_ROWS
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    parser.add_argument("--repeat", help="Runs per benchmark", type=int, default=3)
+    parser.add_argument("--only", help="Benchmark to run (repeatable)", action="append")
+    parser.add_argument("--output", help="File to write results to", type=Path)
+    parser.add_argument("--baseline", help="Results to compare to", type=Path)
+    parser.add_argument(
+        "--threshold",
+        help=f"Fraction slower than baseline that fails (default: {DEFAULT_THRESHOLD})",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+    )
+    args = parser.parse_args()
+    results = run(args.rows, args.seed, args.repeat, args.only or [])
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if args.baseline:
+        if slower := regressions(
+            json.loads(args.baseline.read_text()), results, args.threshold
+        ):
+            logging.error("Benchmarks slower than baseline:\n" + "\n".join(slower))
+            sys.exit(1)
+        logging.info("No regressions compared to baseline")
@@ -1,24 +1,37 @@
+import os
 import sys
+import gzip
 import json
+import shutil
+import re
+import hashlib
 import logging
 import argparse
 import datetime
-import subprocess
-from typing import Final, Any, Tuple
+from functools import cached_property, lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import Final, Any, Callable, Optional, Tuple
 from pathlib import Path
 
 import yaml
 import chevron
+import numpy as np
 import pandas as pd
 import requests
-import inflect  # plurals, counts etc.
-import boto3
-import plotly.io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import cache
+import aggregates
+import stages
+import instrument
+from stages import Stage
+from nextstrain_keys import (
+    NEXTSTRAIN_FILE,
+    NEXTSTRAIN_COMPRESSED_FILE,
+    NEXTSTRAIN_POINTER_FILE,
+)
 
-import choropleth
-import figures.genomics as genomics
-
-readable: Final = inflect.engine()
 logger: Final = logging.getLogger()
 logger.setLevel("INFO")
 
@@ -27,8 +40,83 @@ oneday: Final = datetime.timedelta(days=1)
 week: Final = datetime.timedelta(days=7)
 
 DATA_REPO: Final = "globaldothealth/monkeypox"
-NEXTSTRAIN_FILE: Final = "nextstrain_monkeypox_hmpxv1_metadata.tsv"
+# Nextstrain metadata columns used for filtering and reports
+NEXTSTRAIN_COLUMNS: Final = ["country", "date", "clade_membership", "host"]
+NEXTSTRAIN_CHUNK_SIZE: Final = 100_000  # rows
 DIFFERENCE_LAST_WEEK_COLUMN: Final = "% difference in cases compared to last week"
+TREND_AVERAGE_COLUMN: Final = "Average daily cases (last 7 days)"
+
+DOWNLOAD_WORKERS: Final = 4
+DOWNLOAD_RETRIES: Final = 5
+DOWNLOAD_TIMEOUT: Final = 60  # seconds, between bytes received
+DOWNLOAD_CHUNK_SIZE: Final = 1 << 20
+
+SNAPSHOTS: Final = ["yesterday", "day_before_yesterday", "last_week"]
+# input_files() keys of each snapshot
+SNAPSHOT_FILES: Final = {
+    "yesterday": "file",
+    "day_before_yesterday": "previous_day_file",
+    "last_week": "last_week_file",
+}
+CATEGORICAL_COLUMNS: Final = [
+    "Status",
+    "Country",
+    "Gender",
+    "Travel_history (Y/N/NA)",
+]
+
+# line list columns read for each snapshot, as the report only uses the
+# previous day and last week's snapshots for status and country counts,
+# and last week's counts are usually read from the aggregate store
+SNAPSHOT_COLUMNS: Final = {
+    "yesterday": [
+        "ID",
+        "Status",
+        "Country",
+        "Country_ISO3",
+        "Age",
+        "Gender",
+        "Date_confirmation",
+        "Date_entry",
+        "Travel_history (Y/N/NA)",
+        "Travel_history_entry",
+        "Travel_history_location",
+        "Travel_history_country",
+    ],
+    "day_before_yesterday": ["ID", "Status", "Country"],
+    "last_week": ["Status", "Country", "Gender", "Age"],  # see daily_counts()
+}
+# columns loaded from a snapshot file, whichever roles it is used in
+SNAPSHOT_ALL_COLUMNS: Final = list(
+    dict.fromkeys(c for columns in SNAPSHOT_COLUMNS.values() for c in columns)
+)
+
+# days to compare cumulative confirmed cases over, see trends()
+TREND_HORIZONS: Final = [7, 14, 28]
+TREND_WINDOW: Final = 7  # days, for average daily cases and growth
+
+AGE_BINS: Final = [
+    "0-10",
+    "11-20",
+    "21-30",
+    "31-40",
+    "41-50",
+    "51-60",
+    "61-70",
+    "71-80",
+    "80+",
+]
+AGE_NUMBER: Final = r"\d+(?:\.\d+)?"
+MAX_AGE: Final = 120
+
+# peak memory of the build process expected to fit the build runner
+MEMORY_BUDGET: Final = int(os.getenv("MONKEYPOX_MEMORY_BUDGET", 4 << 30))  # bytes
+
+# Plotly figures embedded in the report, by variable and choropleth function
+PLOTLY_FIGURES: Final = {
+    "embed_choropleth": "figure",
+    "embed_counts": "figure_counts",
+}
 
 FIGURES: Final = [
     "delay-to-confirmation",
@@ -39,23 +127,79 @@ FIGURES: Final = [
 if not (DATA_PATH := Path(__file__).parent / "data").exists():
     DATA_PATH.mkdir()
 BUILD_PATH = Path(__file__).parent.parent / "build"
+ASSETS_PATH = BUILD_PATH / "assets"
+PROFILE_FILE = DATA_PATH / "build.prof"
+# archives listed by the last build that fetched, reused with --skip-fetch
+ARCHIVES_FILE = DATA_PATH / "archives.json"
+# results of build stages keyed by their inputs, see stages.run()
+STAGES_PATH = DATA_PATH / "stages"
+
 
+def fetch_nextstrain(
+    bucket: str, date: datetime.date, file: Path = DATA_PATH / NEXTSTRAIN_FILE
+):
+    """Download Nextstrain metadata for date from bucket to file
+
+    Reads compressed uploads, pointers to earlier uploads, and uncompressed
+    uploads made before compression was introduced.
+    """
+    import boto3
+    import botocore.exceptions
 
-def fetch_nextstrain(bucket: str, date: datetime.date):
     s3 = boto3.client("s3")
-    s3.download_file(
-        bucket, f"{date}/{NEXTSTRAIN_FILE}", str(DATA_PATH / NEXTSTRAIN_FILE)
-    )
 
+    def download_compressed(key: str):
+        compressed = file.with_name(f".{file.name}.gz.part")
+        s3.download_file(bucket, key, str(compressed))
+        with gzip.open(compressed, "rb") as src, file.open("wb") as dst:
+            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+        compressed.unlink()
 
-def read_nextstrain():
-    df = pd.read_csv(DATA_PATH / NEXTSTRAIN_FILE, sep="\t")
-    # B.1 is the 2022 outbreak, but include two A.2 sequences in 2022
-    return df[
-        df.clade_membership.isin(["B.1", "A.2"])
-        & (df.date > "2022")
-        & (df.host == "Homo sapiens")
-    ]
+    try:
+        return download_compressed(f"{date}/{NEXTSTRAIN_COMPRESSED_FILE}")
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+            raise
+    try:
+        pointer = s3.get_object(Bucket=bucket, Key=f"{date}/{NEXTSTRAIN_POINTER_FILE}")
+    except s3.exceptions.NoSuchKey:
+        s3.download_file(bucket, f"{date}/{NEXTSTRAIN_FILE}", str(file))
+    else:
+        download_compressed(json.load(pointer["Body"])["key"])
+
+
+def read_nextstrain(file: Path = DATA_PATH / NEXTSTRAIN_FILE) -> pd.DataFrame:
+    """Reads 2022 outbreak human sequences from Nextstrain metadata
+
+    Only NEXTSTRAIN_COLUMNS are read, filtering the metadata in chunks, and
+    the result is cached in a Parquet file alongside, which is used while
+    it is newer than the metadata.
+    """
+    parquet_file = file.with_suffix(".parquet")
+    if parquet_file.exists() and parquet_file.stat().st_mtime >= file.stat().st_mtime:
+        return pd.read_parquet(parquet_file)
+    df = pd.concat(
+        [
+            # B.1 is the 2022 outbreak, but include two A.2 sequences in 2022
+            chunk[
+                chunk.clade_membership.isin(["B.1", "A.2"])
+                & (chunk.date > "2022")
+                & (chunk.host == "Homo sapiens")
+            ]
+            for chunk in pd.read_csv(
+                file,
+                sep="\t",
+                usecols=NEXTSTRAIN_COLUMNS,
+                dtype=str,
+                chunksize=NEXTSTRAIN_CHUNK_SIZE,
+            )
+        ],
+        ignore_index=True,
+    ).astype(
+        {"country": "category", "clade_membership": "category", "host": "category"}
+    )
+    df.to_parquet(parquet_file, index=False)
+    return df
 
 
 def counts_nextstrain(df: pd.DataFrame) -> dict[str, Any]:
@@ -69,12 +213,178 @@ def counts_nextstrain(df: pd.DataFrame) -> dict[str, Any]:
     }
 
 
-def fetch_urls(urls: list[str], corresponding_filenames: list[str]):
-    for url, filename in zip(urls, corresponding_filenames):
-        with (DATA_PATH / filename).open("wb") as fp:
-            if (res := requests.get(url)).status_code != 200:
-                logging.warning(f"Failed to download {url}")
-            fp.write(res.content)
+def http_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """Returns connection-pooled session that retries with exponential backoff"""
+    retry = Retry(
+        total=DOWNLOAD_RETRIES,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def download(session: requests.Session, url: str, file: Path):
+    """Streams url to file, only replacing file once the download completes"""
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as res:
+        if res.status_code != 200:
+            raise ConnectionError(f"Failed to download {url}: HTTP {res.status_code}")
+        partial = file.with_name(f".{file.name}.part")
+        try:
+            with partial.open("wb") as fp:
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    fp.write(chunk)
+            os.replace(partial, file)
+        finally:
+            partial.unlink(missing_ok=True)
+
+
+def fetch_url(
+    session: requests.Session, url: str, file: Optional[Path], use_cache: bool
+):
+    """Fetches url to file, from the archive cache if present
+
+    file: File to write to, or None to only populate the archive cache
+    """
+    if use_cache:
+        if not (cached := cache.get(url)):
+            cached = cache.path(url)
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            download(session, url, cached)
+        else:
+            logging.info(f"Using cached {url}")
+        if file:
+            cache.copy(cached, file)
+    else:
+        download(session, url, file)
+
+
+def fetch_urls(
+    urls: list[str],
+    corresponding_filenames: Optional[list[str]] = None,
+    use_cache: bool = True,
+):
+    """Downloads urls concurrently to corresponding filenames in DATA_PATH
+
+    corresponding_filenames: Filenames to write to, if None urls are only
+      fetched into the archive cache
+    use_cache: Whether to use the local archive cache, archive files being immutable
+    """
+    files = (
+        [DATA_PATH / filename for filename in corresponding_filenames]
+        if corresponding_filenames
+        else [None] * len(urls)
+    )
+    failed = []
+    with http_session() as session, ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+        futures = {
+            pool.submit(fetch_url, session, url, file, use_cache): url
+            for url, file in zip(urls, files)
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (ConnectionError, requests.RequestException) as e:
+                logging.error(e)
+                failed.append(futures[future])
+    if use_cache:
+        # files fetched for this run may exceed the limit on their own
+        cache.evict(keep=urls)
+    if failed:
+        raise ConnectionError(f"Failed to download {', '.join(failed)}")
+
+
+def ingest(csv_file: Path) -> Path:
+    """Converts a line list CSV to a typed Parquet file alongside it
+
+    CATEGORICAL_COLUMNS are stored as categoricals and Date_* columns are
+    parsed, so later stages do not have to re-parse CSV text.
+    """
+    df = pd.read_csv(
+        csv_file,
+        dtype={column: "category" for column in CATEGORICAL_COLUMNS},
+        low_memory=False,
+    )
+    for column in df.columns:
+        if column.startswith("Date_"):
+            df[column] = pd.to_datetime(df[column], errors="coerce")
+    df.to_parquet(parquet_file := csv_file.with_suffix(".parquet"), index=False)
+    return parquet_file
+
+
+def read_columns(parquet_file: Path, columns: Optional[list[str]]) -> pd.DataFrame:
+    """Reads columns of a snapshot Parquet file, or all columns if None
+
+    Only the requested columns are read from disk. Columns missing from
+    older snapshots are skipped. Repeated strings are read as a single
+    Python object, so object columns do not hold a string per row.
+    """
+    if columns is not None:
+        import pyarrow.parquet
+
+        present = set(pyarrow.parquet.read_schema(parquet_file).names)
+        columns = [c for c in columns if c in present]
+    return pd.read_parquet(parquet_file, columns=columns)
+
+
+def needs_ingest(csv_file: Path) -> bool:
+    "Returns whether a snapshot CSV is not ingested, or newer than its Parquet file"
+    parquet_file = csv_file.with_suffix(".parquet")
+    return not parquet_file.exists() or (
+        csv_file.exists() and csv_file.stat().st_mtime > parquet_file.stat().st_mtime
+    )
+
+
+def read_snapshot(name: str, columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """Reads columns of a line list snapshot, ingesting the CSV if it is
+    newer than the cached Parquet file"""
+    csv_file = DATA_PATH / f"{name}.csv"
+    if needs_ingest(csv_file):
+        logging.info(f"Ingesting {csv_file.name}")
+        ingest(csv_file)
+    return read_columns(csv_file.with_suffix(".parquet"), columns)
+
+
+def fetch_snapshots(urls: list[str], skip_fetch: bool = False) -> dict[str, Path]:
+    """Fetches snapshots into the archive cache and ingests them
+
+    Returns mapping of URL to the snapshot's Parquet file in the cache.
+    Each snapshot is only fetched and ingested once, however many
+    reports it is used in.
+    """
+    if not skip_fetch:
+        fetch_urls(urls)
+    snapshots = {url: cache.path(url).with_suffix(".parquet") for url in urls}
+    if missing := [url for url in urls if not cache.get(url)]:
+        raise FileNotFoundError(f"Snapshots not in cache: {', '.join(missing)}")
+    if to_ingest := [cache.path(url) for url, f in snapshots.items() if not f.exists()]:
+        logging.info(f"Ingesting {len(to_ingest)} snapshots")
+        with ProcessPoolExecutor() as pool:
+            list(pool.map(ingest, to_ingest))
+    return snapshots
+
+
+@lru_cache(maxsize=4)
+def _load_snapshot(file: Path) -> pd.DataFrame:
+    return read_columns(file, SNAPSHOT_ALL_COLUMNS)
+
+
+def load_snapshot(file: Path, name: str) -> pd.DataFrame:
+    """Loads the columns of a snapshot Parquet file used in role name, see
+    SNAPSHOT_COLUMNS
+
+    Each file is loaded once per process with the columns of every role, so
+    a snapshot used in several roles, such as yesterday for one date and
+    the day before yesterday for the next, is not read again.
+    """
+    df = _load_snapshot(file)
+    columns = [c for c in SNAPSHOT_COLUMNS[name] if c in df]
+    return df if len(columns) == len(df.columns) else df[columns]
 
 
 def get_archives_list(suffix: str = "") -> list[str]:
@@ -122,15 +432,36 @@ def get_compare_days(
         return today - 3 * oneday, today - 4 * oneday, today - week
 
 
-def input_files(links: list[str], today: datetime.date) -> dict[str, str]:
-    """Get input files to compare for today"""
+def input_files(
+    links: list[str], today: datetime.date, overrides: dict[str, Any] = {}
+) -> dict[str, str]:
+    """Get input files to compare for today
+
+    overrides: Overrides for today, which may replace any of the input files
+    """
 
     yesterday, day_before_yesterday, last_week = get_compare_days(today)
-    return {
+    files = {
         "file": last_file_on_date(links, yesterday),
         "previous_day_file": last_file_on_date(links, day_before_yesterday),
         "last_week_file": last_file_on_date(links, last_week),
     }
+    return {k: overrides.get(k, v) for k, v in files.items()}
+
+
+def load_overrides(overrides_file: str) -> dict[datetime.date, dict[str, Any]]:
+    """Returns overrides by date from overrides_file"""
+    with open(overrides_file) as fp:
+        return yaml.safe_load(fp) or {}
+
+
+def working_days(start: datetime.date, end: datetime.date) -> list[datetime.date]:
+    """Returns dates from start to end inclusive, excluding weekends"""
+    return [
+        date
+        for n in range((end - start).days + 1)
+        if (date := start + n * oneday).isoweekday() not in [6, 7]
+    ]
 
 
 def initial_filter(df: pd.DataFrame) -> pd.DataFrame:
@@ -138,59 +469,273 @@ def initial_filter(df: pd.DataFrame) -> pd.DataFrame:
     return df[df.Status != "omit_error"].reset_index(drop=True)
 
 
-def table_confirmed_cases(df, prev_week_df: pd.DataFrame) -> dict[str, str]:
-    """Returns variables to populate Table 1: Confirmed cases by country"""
-    df = initial_filter(df)
-    prev_week_df = initial_filter(prev_week_df)
+class CaseSummary:
+    """Precomputed summary of a line list snapshot
 
-    yesterday_counts = (
-        df[df.Status == "confirmed"].groupby("Country").count()[["Status"]]
-    )
-    last_week_counts = (
-        prev_week_df[prev_week_df.Status == "confirmed"]
-        .groupby("Country")
-        .count()[["Status"]]
-    )
-    table = yesterday_counts.merge(last_week_counts, on="Country").rename(
-        columns={"Status_x": "Confirmed", "Status_y": "Confirmed_last_week"}
+    Built once per snapshot so that metrics share a single filtering pass:
+
+    df: Line list after initial_filter()
+    status_country: Status x Country matrix of case counts, including
+      cases with missing status or country under NaN
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = initial_filter(df)
+        # groupby(dropna=False) drops missing categories in pandas < 2
+        status, statuses = pd.factorize(self.df.Status)
+        country, country_names = pd.factorize(self.df.Country)
+        self.status_country = (
+            pd.DataFrame({"Status": status, "Country": country})
+            .groupby(["Status", "Country"])
+            .size()
+            .unstack(fill_value=0)
+        )
+        self.status_country.index = pd.Index(
+            np.append(np.asarray(statuses, dtype=object), np.nan)[
+                self.status_country.index
+            ],
+            name="Status",
+        )
+        self.status_country.columns = pd.Index(
+            np.append(np.asarray(country_names, dtype=object), np.nan)[
+                self.status_country.columns
+            ],
+            name="Country",
+        )
+        self.status_country = self.status_country.sort_index().sort_index(axis=1)
+        self._masks: dict[str, pd.Series] = {}
+
+    def mask(self, status: str | list[str]) -> pd.Series:
+        """Returns boolean mask of rows having a given status(es)"""
+        statuses = [status] if isinstance(status, str) else status
+        key = ",".join(sorted(statuses))
+        if key not in self._masks:
+            self._masks[key] = self.df.Status.isin(statuses)
+        return self._masks[key]
+
+    def status_counts(self, status: str | list[str]) -> pd.Series:
+        """Returns number of cases by country for a given status(es)"""
+        statuses = [status] if isinstance(status, str) else status
+        return self.status_country.reindex(statuses, fill_value=0).sum()
+
+    @cached_property
+    def confirmed(self) -> pd.DataFrame:
+        """Confirmed cases"""
+        return self.df[self.mask("confirmed")]
+
+    @cached_property
+    def unique_ids(self) -> bool:
+        """Whether each case ID occurs once"""
+        return not self.df.ID.duplicated().any()
+
+    @cached_property
+    def ages(self) -> pd.DataFrame:
+        """Parsed ages, see parse_ages()"""
+        return parse_ages(self.df.Age)
+
+    @cached_property
+    def confirmed_ages(self) -> pd.DataFrame:
+        """Parsed ages of confirmed cases"""
+        return self.ages[self.mask("confirmed")]
+
+    @classmethod
+    def from_counts(cls, counts: pd.DataFrame) -> "CaseSummary":
+        """Returns summary of stored counts, as returned by daily_counts()
+
+        Only supports metrics using status_country, as the line list is
+        not available.
+        """
+        summary = cls.__new__(cls)
+        summary.df = None
+        summary.status_country = (
+            counts.groupby(["Status", "Country"]).n.sum().unstack(fill_value=0)
+        )
+        summary._masks = {}
+        return summary
+
+
+def summarise(data: pd.DataFrame | CaseSummary) -> CaseSummary:
+    """Returns CaseSummary for data, reusing it if already summarised"""
+    return data if isinstance(data, CaseSummary) else CaseSummary(data)
+
+
+def daily_counts(data: pd.DataFrame | CaseSummary) -> pd.DataFrame:
+    """Returns number of cases by country, status, gender and age bucket
+
+    Returns columns of aggregates.COLUMNS, with gender '' and age bucket -1
+    where unknown.
+    """
+    df = summarise(data).df
+    return (
+        pd.DataFrame(
+            {
+                "Country": df.Country.astype(str),
+                "Status": df.Status.astype(str),
+                "Gender": df.Gender.astype(object).fillna("") if "Gender" in df else "",
+                "Age_bucket": summarise(data).ages.Age_start_bucket.fillna(-1)
+                if "Age" in df
+                else -1,
+            }
+        )
+        .groupby(["Country", "Status", "Gender", "Age_bucket"])
+        .size()
+        .reset_index(name="n")
     )
+
+
+def stored_summary(
+    file: str, date: datetime.date, read: Callable[[], pd.DataFrame]
+) -> CaseSummary:
+    """Returns summary of an earlier snapshot from the aggregate store
+
+    If the snapshot at file URL is not stored, it is read with read() and
+    its counts are stored for later reports.
+    """
+    if (counts := aggregates.load(file)) is not None:
+        logging.info(f"Using stored counts for {file}")
+        return CaseSummary.from_counts(counts)
+    summary = CaseSummary(read())
+    aggregates.save(file, date, daily_counts(summary))
+    return summary
+
+
+def confirmed_by_country(data: pd.DataFrame | CaseSummary) -> pd.Series:
+    """Returns number of confirmed cases by country, for countries with cases"""
+    confirmed = summarise(data).status_counts("confirmed")
+    return confirmed[(confirmed > 0) & confirmed.index.notna()]
+
+
+def trends(
+    history: pd.DataFrame, date: datetime.date, horizons: list[int] = TREND_HORIZONS
+) -> Optional[pd.DataFrame]:
+    """Returns trends of cumulative cases by country, up to date
+
+    history: Cumulative cases by date and country, as returned by
+      aggregates.history(); weekends carry forward the previous Friday's
+      cases, other days without data are missing
+    horizons: Days to compare cases over
+
+    Returns dataframe indexed by country, with a Total row, and columns
+    Cases, Diff_<h>d and Pc_diff_<h>d for each horizon h, with the number
+    and percentage of cases added over h days, and Avg_daily and Growth with
+    the average daily cases added over the last TREND_WINDOW days and their
+    percentage growth over the TREND_WINDOW days before. Trends are missing
+    where there is no data for the earlier date. Returns None if there is
+    no data for date.
+    """
+    date = pd.Timestamp(date)
+    if date not in history.index:
+        return None
+    history = history.loc[:date].assign(Total=lambda h: h.sum(axis=1))
+    daily = history.reindex(pd.date_range(history.index[0], date)).ffill(limit=2)
+    # cases on date and every earlier date compared to, in one lookup
+    lags = sorted(set(horizons) | {0, TREND_WINDOW, 2 * TREND_WINDOW})
+    cases = daily.reindex([date - pd.Timedelta(days=lag) for lag in lags])
+    cases.index = lags
+    added = cases.loc[0] - cases
+    pc_added = 100 * added / cases.where(cases > 0)
+    window = added.loc[TREND_WINDOW]
+    previous_window = cases.loc[TREND_WINDOW] - cases.loc[2 * TREND_WINDOW]
+    return pd.DataFrame(
+        {
+            "Cases": cases.loc[0],
+            **{f"Diff_{h}d": added.loc[h] for h in horizons},
+            **{f"Pc_diff_{h}d": pc_added.loc[h] for h in horizons},
+            "Avg_daily": window / TREND_WINDOW,
+            "Growth": 100 * (window / previous_window.where(previous_window > 0) - 1),
+        }
+    ).rename_axis("Country")
+
+
+def trend_variables(trend: Optional[pd.DataFrame]) -> dict[str, Any]:
+    """Returns report variables of total confirmed case trends, see trends()
+
+    Variables are null where trends are missing.
+    """
+    if trend is None:
+        return {}
+    total = trend.loc["Total"]
+    horizons = [column[5:] for column in trend.columns if column.startswith("Diff_")]
+
+    def value(column: str, digits: Optional[int] = None) -> Optional[float]:
+        if pd.isna(total[column]):
+            return None
+        return int(total[column]) if digits is None else round(total[column], digits)
+
+    return {
+        **{f"n_diff_confirmed_{h}": value(f"Diff_{h}") for h in horizons},
+        **{f"pc_diff_confirmed_{h}": value(f"Pc_diff_{h}", 1) for h in horizons},
+        "avg_daily_confirmed": value("Avg_daily", 1),
+        "growth_confirmed": value("Growth", 1),
+    }
+
+
+def table_confirmed_cases(
+    df: pd.DataFrame | CaseSummary,
+    prev_week_df: pd.DataFrame | CaseSummary,
+    trend: Optional[pd.DataFrame] = None,
+) -> dict[str, str]:
+    """Returns variables to populate Table 1: Confirmed cases by country
+
+    trend: Trends by country, as returned by trends(), to add columns with
+      the percentage difference over horizons other than a week, and
+      average daily cases
+    """
+    table = pd.concat(
+        [
+            confirmed_by_country(df).rename("Confirmed"),
+            confirmed_by_country(prev_week_df).rename("Confirmed_last_week"),
+        ],
+        axis=1,
+        join="inner",
+    ).rename_axis("Country")
     table[DIFFERENCE_LAST_WEEK_COLUMN] = (
         100 * (table.Confirmed - table.Confirmed_last_week) / table.Confirmed_last_week
     ).astype(int)
+    columns = ["Confirmed", DIFFERENCE_LAST_WEEK_COLUMN]
+    if trend is not None:
+        for column in trend.columns:
+            if column.startswith("Pc_diff_") and column != "Pc_diff_7d":
+                name = f"% difference compared to {column[8:-1]} days ago"
+                table[name] = trend[column].reindex(table.index).round().astype("Int64")
+                columns.append(name)
+        table[TREND_AVERAGE_COLUMN] = trend.Avg_daily.reindex(table.index).round(1)
+        columns.append(TREND_AVERAGE_COLUMN)
     return {
-        "embed_table_confirmed_cases": table[["Confirmed", DIFFERENCE_LAST_WEEK_COLUMN]]
+        "embed_table_confirmed_cases": table[columns]
         .reset_index()
         .sort_values("Confirmed", ascending=False)
-        .to_html(index=False)
+        .to_html(index=False, na_rep="")
     }
 
 
-def n_cases(df: pd.DataFrame, status: str | list[str]) -> int:
+def n_cases(df: pd.DataFrame | CaseSummary, status: str | list[str]) -> int:
     """Returns number of cases for a given status"""
-
-    df = initial_filter(df)
-    statuses = [status] if isinstance(status, str) else status
-    return len(df[df.Status.isin(statuses)])
+    return int(summarise(df).status_counts(status).sum())
 
 
 def countries(
-    df: pd.DataFrame, status: str | list[str], only: bool = False
+    df: pd.DataFrame | CaseSummary, status: str | list[str], only: bool = False
 ) -> set[str]:
-    """Returns set of countries for a given status
+    """Returns set of countries for a given status, including NaN if
+    cases with the status have a missing country
 
     only: Whether to return number of countries only having that status(es)
     """
-    df = initial_filter(df)
+    summary = summarise(df)
     statuses = [status] if isinstance(status, str) else status
+    with_status = summary.status_counts(statuses) > 0
     if not only:
-        return set(df[df.Status.isin(statuses)].Country)
+        return set(with_status[with_status].index)
     else:
-        return set(df[df.Status.isin(statuses)].Country) - set(
-            df[~df.Status.isin(statuses)].Country
-        )
+        others = [s for s in summary.status_country.index if s not in statuses]
+        with_others = summary.status_counts(others) > 0
+        return set(with_status[with_status & ~with_others].index)
 
 
-def n_countries(df: pd.DataFrame, status: str | list[str], only: bool = False) -> int:
+def n_countries(
+    df: pd.DataFrame | CaseSummary, status: str | list[str], only: bool = False
+) -> int:
     """Returns number of countries for a given status
 
     only: Whether to return number of countries only having that status(es)
@@ -199,53 +744,132 @@ def n_countries(df: pd.DataFrame, status: str | list[str], only: bool = False) -
     return len(countries(df, status, only))
 
 
-def travel_history_counts(df: pd.DataFrame) -> dict[str, int]:
-    df = initial_filter(df)
-    df = df[df.Status == "confirmed"]
+def travel_history_counts(df: pd.DataFrame | CaseSummary) -> dict[str, int]:
+    df = summarise(df).confirmed
+    travelled = df["Travel_history (Y/N/NA)"] == "Y"
     return {
-        "n_travel_history": len(df[df["Travel_history (Y/N/NA)"] == "Y"]),
-        "n_unknown_travel_history": len(
-            df[
-                (df["Travel_history (Y/N/NA)"] == "Y")
-                & pd.isnull(df.Travel_history_location)
-            ]
+        "n_travel_history": int(travelled.sum()),
+        "n_unknown_travel_history": int(
+            (travelled & pd.isnull(df.Travel_history_location)).sum()
         ),
     }
 
 
+def changes(
+    df: pd.DataFrame | CaseSummary, prev_df: pd.DataFrame | CaseSummary
+) -> pd.DataFrame:
+    """Returns change set of cases between two line lists, joined on ID
+
+    Each row is a case that was added, removed, or changed status or country,
+    with columns ID, Status_prev, Status, Country_prev and Country. Missing
+    values indicate the case was absent from that line list. If an ID occurs
+    more than once in a line list, its last occurrence is used.
+    """
+    columns = ["ID", "Status", "Country"]
+    df, prev_df = summarise(df), summarise(prev_df)
+    if not (df.unique_ids and prev_df.unique_ids):
+        logging.warning("Duplicate case IDs, using the last case with each ID")
+    joined = (
+        prev_df.df[columns]
+        .drop_duplicates("ID", keep="last")
+        .astype(object)
+        .merge(
+            df.df[columns].drop_duplicates("ID", keep="last").astype(object),
+            on="ID",
+            how="outer",
+            suffixes=("_prev", ""),
+        )
+    )
+
+    def differs(prev: pd.Series, current: pd.Series) -> pd.Series:
+        return (prev != current) & ~(prev.isna() & current.isna())
+
+    changed = differs(joined.Status_prev, joined.Status) | differs(
+        joined.Country_prev, joined.Country
+    )
+    return joined[changed][
+        ["ID", "Status_prev", "Status", "Country_prev", "Country"]
+    ].reset_index(drop=True)
+
+
+def status_transitions(change_set: pd.DataFrame) -> dict[str, int]:
+    """Returns number of cases by status transition, such as suspected_to_confirmed
+
+    Cases that were added or removed are counted as transitions from or to 'none'
+    """
+    return {
+        f"{prev}_to_{status}": int(n)
+        for (prev, status), n in change_set.fillna(
+            {"Status_prev": "none", "Status": "none"}
+        )
+        .query("Status_prev != Status")
+        .groupby(["Status_prev", "Status"])
+        .size()
+        .items()
+    }
+
+
+@lru_cache(maxsize=None)
+def readable():
+    "Returns inflect engine for plurals, counts etc."
+    import inflect
+
+    return inflect.engine()
+
+
 def text_diff_countries(countries: set) -> str:
     """Returns text about new countries"""
     if countries:
+        engine = readable()
         return (
-            f", and {len(countries)} new {readable.plural_noun('country', len(countries))} "
-            f"{readable.plural_verb('has', len(countries))} been added to the list ({', '.join(sorted(countries))})"
+            f", and {len(countries)} new {engine.plural_noun('country', len(countries))} "
+            f"{engine.plural_verb('has', len(countries))} been added to the list ({', '.join(sorted(countries))})"
         )
     else:
         return ""
 
 
-def counts(df: pd.DataFrame, prev_df: pd.DataFrame) -> dict[str, int]:
+def counts(
+    df: pd.DataFrame | CaseSummary,
+    prev_df: pd.DataFrame | CaseSummary,
+    change_set: Optional[pd.DataFrame] = None,
+) -> dict[str, int]:
     """Return count variables from data
 
     df: Today's data file as a dataframe
     prev_df: Previous day's data file as a dataframe
+    change_set: Changes from prev_df to df, as returned by changes()
     """
+    df, prev_df = summarise(df), summarise(prev_df)
+    confirmed_or_suspected = ["confirmed", "suspected"]
+    if df.unique_ids and prev_df.unique_ids:
+        if change_set is None:
+            change_set = changes(df, prev_df)
+        # new countries can only come from cases that were added or changed
+        candidates = set(
+            change_set[change_set.Status.isin(confirmed_or_suspected)].Country.dropna()
+        )
+        n_diff_confirmed = (change_set.Status == "confirmed").sum() - (
+            change_set.Status_prev == "confirmed"
+        ).sum()
+    else:
+        # cases cannot be matched by ID, so compare aggregates
+        candidates = countries(df, confirmed_or_suspected)
+        n_diff_confirmed = n_cases(df, "confirmed") - n_cases(prev_df, "confirmed")
     new_countries = sorted(
-        countries(df, ["confirmed", "suspected"])
-        - countries(prev_df, ["confirmed", "suspected"])
+        {c for c in candidates if pd.notna(c)}
+        - countries(prev_df, confirmed_or_suspected)
     )
     return {
-        "n_countries_confirmed_or_suspected": n_countries(
-            df, ["confirmed", "suspected"]
-        ),
+        "n_countries_confirmed_or_suspected": n_countries(df, confirmed_or_suspected),
         "n_countries_confirmed": n_countries(df, "confirmed"),
         "n_countries_suspected_only": n_countries(df, "suspected", only=True),
         "n_countries_discarded": n_countries(df, "discarded"),
         "n_countries_discarded_only": n_countries(df, "discarded", only=True),
         "n_confirmed": n_cases(df, "confirmed"),
         "n_suspected": n_cases(df, "suspected"),
-        "n_confirmed_or_suspected": n_cases(df, ["confirmed", "suspected"]),
-        "n_diff_confirmed": n_cases(df, "confirmed") - n_cases(prev_df, "confirmed"),
+        "n_confirmed_or_suspected": n_cases(df, confirmed_or_suspected),
+        "n_diff_confirmed": int(n_diff_confirmed),
         "diff_countries": new_countries,
         "n_diff_countries": len(new_countries),
         "text_diff_countries": text_diff_countries(new_countries),
@@ -253,52 +877,67 @@ def counts(df: pd.DataFrame, prev_df: pd.DataFrame) -> dict[str, int]:
     }
 
 
-def travel_history(df: pd.DataFrame) -> dict[str, str]:
-    df = initial_filter(df)
+def travel_history(df: pd.DataFrame | CaseSummary) -> dict[str, str]:
+    df = summarise(df).df
     df_travel = df[df["Travel_history (Y/N/NA)"] == "Y"]
-    travel_counts_by_country = [
-        (country, len(group)) for country, group in df_travel.groupby("Country")
-    ]
+    travel_counts_by_country = df_travel.groupby("Country", observed=True).size()
     return {
         "text_travel_history": ", ".join(
-            f"{n} were from {country}" for country, n in travel_counts_by_country
+            f"{n} were from {country}"
+            for country, n in travel_counts_by_country.items()
         )
     }
 
 
-def mid_bucket_age(age_interval: str) -> float:
-    try:  # if age_interval is a number, return that
-        return float(age_interval)
-    except ValueError:
-        pass
-    try:
-        start, end = list(map(float, age_interval.split("-")))
-        return (start + end) / 2
-    except Exception as e:
-        logging.exception(e)
-        return None
-
-
-def age_bucket(age: int) -> int:
-    """Returns age bucket from
+def age_buckets(age: pd.Series) -> pd.Series:
+    """Returns age bucket indices of AGE_BINS for ages from 0 to 120
 
     0 - 10, 11 - 20, 21 - 30, 31 - 40, 41 - 50,
     51 - 60, 61 - 70, 71 - 80, 81 -
     """
-    if age < 0 or age > 120:
-        raise ValueError(f"Invalid age {age}")
-    if age == 0:
-        return 0
     # ages above 80 are in the same bucket
-    return min((age - 1) // 10, 8)
+    return ((np.ceil(age) - 1) // 10).clip(0, len(AGE_BINS) - 1).astype("Int8")
 
 
-def not_same_age_bucket(age: str) -> bool:
-    try:
-        start_age, end_age = list(map(lambda x: int(x.strip()), age.split("-")))
-    except ValueError:
-        return False
-    return age_bucket(start_age) != age_bucket(end_age)
+def parse_ages(age: pd.Series) -> pd.DataFrame:
+    """Parses ages and age ranges such as 35 and 20-29
+
+    Returns dataframe with the index of age, with columns Age_start, Age_end,
+    Age_mid, and Age_start_bucket and Age_end_bucket (see age_buckets()),
+    which are missing for missing or invalid ages. Invalid ages, which are
+    not numbers or ranges from 0 to 120, are reported once as a summary.
+
+    Ages take few distinct values, so each distinct value is parsed once.
+    """
+    codes, values = pd.factorize(age)
+    text = pd.Series(values, dtype=object).astype(str).str.strip()
+    parts = text.str.extract(rf"^({AGE_NUMBER})(?:\s*-\s*({AGE_NUMBER}))?$")
+    start = pd.to_numeric(parts[0], errors="coerce")
+    end = pd.to_numeric(parts[1], errors="coerce").fillna(start)
+    valid = start.between(0, MAX_AGE) & end.between(0, MAX_AGE) & (start <= end)
+    n_cases = pd.Series(np.bincount(codes[codes >= 0], minlength=len(values)))
+    if (invalid := n_cases[~valid & (text != "")]).sum():
+        logging.warning(
+            f"Ignoring {invalid.sum()} invalid ages: "
+            + ", ".join(
+                f"{text[i]} ({n})"
+                for i, n in invalid.sort_values(ascending=False).head(10).items()
+            )
+        )
+    start, end = start.where(valid), end.where(valid)
+    ages = pd.DataFrame(
+        {
+            "Age_start": start,
+            "Age_end": end,
+            "Age_mid": (start + end) / 2,
+            "Age_start_bucket": age_buckets(start),
+            "Age_end_bucket": age_buckets(end),
+        }
+    ).reindex(
+        codes
+    )  # missing ages have code -1
+    ages.index = age.index
+    return ages
 
 
 def percentage_occurrence(df: pd.DataFrame, filter_series: pd.Series) -> int:
@@ -306,16 +945,14 @@ def percentage_occurrence(df: pd.DataFrame, filter_series: pd.Series) -> int:
     return int(round(100 * sum(filter_series) / len(df)))
 
 
-def demographics(df: pd.DataFrame) -> dict[str, int]:
-    df = initial_filter(df)
-    df = df[df.Status == "confirmed"]
-    df["Age_mid"] = df.Age.map(mid_bucket_age)
-    valid_age_df = df[~pd.isnull(df.Age_mid)]
-    valid_age_gender = df[
+def demographics(df: pd.DataFrame | CaseSummary) -> dict[str, int]:
+    summary = summarise(df)
+    df, ages = summary.confirmed, summary.confirmed_ages
+    valid_age_gender = (
         (df.Age != "<40") & (~df.Age.isna()) & (df.Gender.isin(["male", "female"]))
-    ].reset_index(drop=True)
+    )
     return {
-        "mean_age_confirmed_cases": int(valid_age_df.Age_mid.mean()),
+        "mean_age_confirmed_cases": int(ages.Age_mid.mean()),
         "percentage_male": percentage_occurrence(
             df[~pd.isnull(df.Gender)], df.Gender == "male"
         ),
@@ -323,21 +960,67 @@ def demographics(df: pd.DataFrame) -> dict[str, int]:
             df, (~df.Age.isna()) & (~df.Gender.isna()) & (df.Age != "<40")
         ),
         "pc_age_range_multiple_buckets": percentage_occurrence(
-            valid_age_gender, valid_age_gender.Age.map(not_same_age_bucket)
+            df[valid_age_gender],
+            (ages.Age_start_bucket != ages.Age_end_bucket).fillna(False)[
+                valid_age_gender
+            ],
         ),
     }
 
 
-def delay_suspected_to_confirmed(df: pd.DataFrame) -> dict[str, Any]:
+def age_gender(df: pd.DataFrame | CaseSummary) -> pd.DataFrame:
+    """Returns confirmed cases by age bucket and gender for the age-gender figure
+
+    Cases with an age range spanning several buckets are split equally
+    between the buckets. Returns columns Age (from AGE_BINS), Gender (male
+    or female) and total, for every bucket and gender. Genders are compared
+    ignoring case and surrounding whitespace.
+    """
+    summary = summarise(df)
+    df, ages = summary.confirmed, summary.confirmed_ages
+    # normalised once per distinct value
+    gender = df.Gender.map(
+        {g: str(g).strip().lower() for g in df.Gender.dropna().unique()}
+    )
+    valid = ages.Age_start_bucket.notna() & gender.isin(["male", "female"])
+    start = ages.Age_start_bucket[valid].to_numpy(int)
+    n_buckets = ages.Age_end_bucket[valid].to_numpy(int) - start + 1
+    # one row per case and bucket, offset from the start bucket
+    case = np.repeat(np.arange(len(start)), n_buckets)
+    offset = np.arange(len(case)) - np.repeat(
+        np.cumsum(n_buckets) - n_buckets, n_buckets
+    )
+    totals = (
+        pd.DataFrame(
+            {
+                "Age": start[case] + offset,
+                "Gender": gender[valid].astype(str).to_numpy()[case],
+                "total": 1 / n_buckets[case],
+            }
+        )
+        .groupby(["Age", "Gender"])
+        .total.sum()
+        .reindex(
+            pd.MultiIndex.from_product(
+                [range(len(AGE_BINS)), ["male", "female"]], names=["Age", "Gender"]
+            ),
+            fill_value=0,
+        )
+        .reset_index()
+    )
+    return totals.assign(Age=totals.Age.map(dict(enumerate(AGE_BINS))))
+
+
+def delay_suspected_to_confirmed(df: pd.DataFrame | CaseSummary) -> dict[str, Any]:
     """Returns mean and median delay from a case going from suspected to confirmed"""
 
-    df = initial_filter(df)
-    df = df[df.Status == "confirmed"].assign(
+    df = summarise(df).confirmed
+    df = df.assign(
         Date_entry=pd.to_datetime(df.Date_entry),
-        Date_confirmation=pd.to_datetime(df.Date_confirmation)
+        Date_confirmation=pd.to_datetime(df.Date_confirmation),
     )
     delay_df = df[df.Date_entry < df.Date_confirmation]
-    delay_df["Delay"] = delay_df.Date_confirmation - delay_df.Date_entry
+    delay_df = delay_df.assign(Delay=delay_df.Date_confirmation - delay_df.Date_entry)
     return {
         "mean_delay_suspected_confirmed": round(
             delay_df.Delay.mean().total_seconds() / 86400, 2
@@ -352,8 +1035,135 @@ def render(template: Path, variables: dict[str, Any], output: Path):
         output.write_text(chevron.render(f, variables))
 
 
-def render_figure(fig, key: str) -> str:
-    return {key: plotly.io.to_html(fig, include_plotlyjs=False, full_html=False)}
+def render_figure(fig, key: str, assets_path: Optional[Path] = None) -> dict[str, str]:
+    """Returns HTML embedding a Plotly figure
+
+    assets_path: If specified, the figure is written to a content-hashed,
+      gzip-compressed JSON file in assets_path, which the page loads when the
+      figure scrolls into view, instead of being inlined in the HTML
+    """
+    if assets_path is None:
+        import plotly.io
+
+        return {key: plotly.io.to_html(fig, include_plotlyjs=False, full_html=False)}
+    spec = fig.to_json().encode("utf-8")
+    name = f"{hashlib.sha256(spec).hexdigest()[:20]}.json"
+    if not (file := assets_path / name).exists():
+        assets_path.mkdir(exist_ok=True)
+        partial = file.with_name(f".{name}.part")
+        partial.write_bytes(gzip.compress(spec, mtime=0))
+        os.replace(partial, file)
+    # shared by the reports of every date, so each asset is stored and
+    # cached by browsers once
+    return {key: f'<div class="plotly-figure" data-src="/assets/{name}"></div>'}
+
+
+def figure_variables(
+    key: str, parquet_file: Path, assets_path: Optional[Path] = None
+) -> dict[str, str]:
+    """Returns HTML embedding Plotly figure in PLOTLY_FIGURES, see render_figure()
+
+    parquet_file: Ingested snapshot of yesterday, read here rather than
+      passed in, as figures are drawn in worker processes
+    """
+    import choropleth
+
+    df = read_columns(parquet_file, SNAPSHOT_COLUMNS["yesterday"])
+    return render_figure(getattr(choropleth, PLOTLY_FIGURES[key])(df), key, assets_path)
+
+
+def figure_assets(var: dict[str, str]) -> list[Path]:
+    "Returns asset files referenced by figure variables, see render_figure()"
+    return [
+        ASSETS_PATH / name
+        for html in var.values()
+        for name in re.findall(r'data-src="/assets/([^"]+)"', html)
+    ]
+
+
+def ingest_snapshot(csv_file: Optional[Path], fetched: bool = True) -> Optional[Path]:
+    """Ingests a snapshot, see ingest()
+
+    csv_file: Snapshot to ingest, if None, there is nothing to ingest
+    fetched: Whether the snapshot was fetched, if not, it is only ingested
+      if the CSV is newer than the Parquet file, see needs_ingest()
+    """
+    if csv_file and (fetched or needs_ingest(csv_file)):
+        return ingest(csv_file)
+    return None
+
+
+def code_version() -> str:
+    "Returns hash of the build code and the pandas version, see stages.run()"
+    sha = hashlib.sha256(pd.__version__.encode())
+    for file in sorted(Path(__file__).parent.glob("**/*.py")):
+        if not file.name.startswith("test_"):
+            sha.update(file.read_bytes())
+    return sha.hexdigest()
+
+
+def report_variables(
+    date: datetime.date,
+    df: pd.DataFrame | CaseSummary,
+    prev_df: pd.DataFrame | CaseSummary,
+    last_week_df: pd.DataFrame | CaseSummary,
+    genome_data: pd.DataFrame,
+    changes_file: Optional[Path] = None,
+    history: Optional[pd.DataFrame] = None,
+) -> dict[str, Any]:
+    """Returns report variables computed from line list snapshots
+
+    df: Yesterday's line list
+    prev_df: Day before yesterday's line list
+    last_week_df: Last week's line list
+    genome_data: Nextstrain metadata, as returned by read_nextstrain()
+    changes_file: If specified, CSV file to write changes since prev_df to
+    history: Cumulative confirmed cases by date and country, as returned by
+      aggregates.history(), to report trends over TREND_HORIZONS
+    """
+    yesterday, day_before_yesterday, _ = get_compare_days(date)
+    var = {
+        "date": date.isoformat(),
+        "yesterday": yesterday.isoformat(),
+        "day_before_yesterday": day_before_yesterday.isoformat(),
+        **counts_nextstrain(genome_data),
+    }
+    with instrument.span("summarise"):
+        summary, prev_summary = summarise(df), summarise(prev_df)
+        last_week_summary = summarise(last_week_df)
+    with instrument.span("changes"):
+        change_set = changes(summary, prev_summary)
+        if changes_file:
+            change_set.to_csv(changes_file, index=False)
+    with instrument.span("counts"):
+        var.update(counts(summary, prev_summary, change_set))
+        var["status_transitions"] = status_transitions(change_set)
+    with instrument.span("trends"):
+        trend = trends(history, yesterday) if history is not None else None
+        var.update(trend_variables(trend))
+    with instrument.span("table_confirmed_cases"):
+        var.update(table_confirmed_cases(summary, last_week_summary, trend))
+    with instrument.span("travel_history"):
+        var.update(travel_history(summary))
+    with instrument.span("demographics"):
+        var.update(demographics(summary))
+    with instrument.span("delay_suspected_to_confirmed"):
+        var.update(delay_suspected_to_confirmed(summary))
+
+    # remove these for now
+    del var["text_travel_history"]
+    return var
+
+
+def write_variables(var: dict[str, Any], file: Path):
+    """Writes report variables, except embedded HTML, to JSON file"""
+    with file.open("w") as fp:
+        json.dump(
+            {k: v for k, v in var.items() if not k.startswith("embed_")},
+            fp,
+            indent=2,
+            sort_keys=True,
+        )
 
 
 def build(
@@ -362,92 +1172,456 @@ def build(
     skip_fetch: bool = False,
     skip_figures: bool = False,
     overrides_file: str = "overrides.yml",
+    figure_workers: Optional[int] = None,
+    figure_timeout: int = 600,
+    external_figures: bool = False,
+    stage_cache: bool = True,
 ):
-    """Build Monkeypox epidemiological report for a particular date"""
-    var = {}
-    with open(overrides_file) as fp:
-        overrides = yaml.safe_load(fp)
+    """Build Monkeypox epidemiological report for a particular date
+
+    figure_workers: Number of figures to render at the same time
+    figure_timeout: Timeout in seconds for rendering each figure
+    external_figures: Write Plotly figures to compressed assets in
+      build/assets instead of inlining them in index.html
+    stage_cache: Reuse results of stages whose inputs did not change since
+      an earlier build, see stages.run()
+    """
+    import figures.genomics as genomics
+    import figures.render
+
     date = date or today
-    if date in overrides:
-        overrides = overrides[date]
+    if overrides := load_overrides(overrides_file).get(date, {}):
         logging.info(f"Found overrides for {date} in {overrides_file}")
         logging.info(yaml.dump(overrides))
-    else:
-        overrides = {}
-    if not skip_fetch:
-        logging.info("Fetch nextstrain data from S3")
-        fetch_nextstrain(fetch_bucket, date)
-    genome_data = read_nextstrain()
-    var.update(counts_nextstrain(genome_data))
-    yesterday, day_before_yesterday, _ = get_compare_days(date)
-    var.update(
-        {
-            "date": date.isoformat(),
-            "yesterday": yesterday.isoformat(),
-            "day_before_yesterday": day_before_yesterday.isoformat(),
+    yesterday, _, last_week = get_compare_days(date)
+    assets_path = ASSETS_PATH if external_figures else None
+
+    def nextstrain() -> pd.DataFrame:
+        if not skip_fetch:
+            logging.info("Fetch nextstrain data from S3")
+            fetch_nextstrain(fetch_bucket, date)
+        return read_nextstrain()
+
+    def files() -> dict[str, str]:
+        if skip_fetch and ARCHIVES_FILE.exists():
+            links = json.loads(ARCHIVES_FILE.read_text())
+        else:
+            links = get_archives_list("csv")
+            ARCHIVES_FILE.write_text(json.dumps(links))
+        return input_files(links, date, overrides)
+
+    def fetch_snapshot(name: str) -> Callable[..., Optional[Path]]:
+        def fetch(files: dict[str, str], *last_week_counts) -> Optional[Path]:
+            if last_week_counts and last_week_counts[0] is not None:
+                return None  # last week's counts are stored
+            if not skip_fetch:
+                fetch_urls([files[SNAPSHOT_FILES[name]]], [f"{name}.csv"])
+            return (
+                csv_file if (csv_file := DATA_PATH / f"{name}.csv").exists() else None
+            )
+
+        return fetch
+
+    def last_week_summary(files) -> CaseSummary:
+        return stored_summary(
+            files["last_week_file"],
+            last_week,
+            lambda: read_snapshot("last_week", SNAPSHOT_COLUMNS["last_week"]),
+        )
+
+    def variables(files, summary, prev_df, last_week_summary, genome_data, history):
+        return {
+            **files,
+            **report_variables(
+                date,
+                summary,
+                prev_df,
+                last_week_summary,
+                genome_data,
+                changes_file=BUILD_PATH / "changes.csv",
+                history=history,
+            ),
+            **overrides,
         }
-    )
 
+    def render_report(var, *figure_vars):
+        figure_var = {k: v for figure_var in figure_vars for k, v in figure_var.items()}
+        var = {**var, **figure_var}  # var is the cached result of variables
+        if assets_path and assets_path.exists():
+            # assets from earlier reports are already published
+            for asset in set(assets_path.iterdir()) - set(figure_assets(figure_var)):
+                asset.unlink()
+        logging.info("Rendering index.html")
+        render(Path(__file__).parent / "index.html", var, BUILD_PATH / "index.html")
+        logging.info("Writing variables to index.json")
+        write_variables(var, BUILD_PATH / "index.json")
+
+    def r_figures():
+        with figures.render.RWorkerPool(figure_workers or len(FIGURES)) as pool:
+            figures.render.render_figures(FIGURES, pool, timeout=figure_timeout)
+
+    build_stages = [
+        Stage("nextstrain", nextstrain, volatile=True),
+        Stage("files", files, volatile=True),
+        # last week's counts are usually stored by an earlier build
+        Stage(
+            "last_week_counts",
+            lambda files: aggregates.load(files["last_week_file"]),
+            inputs=["files"],
+            volatile=True,
+        ),
+        *[
+            stage
+            for name in SNAPSHOTS
+            for stage in [
+                Stage(
+                    f"fetch/{name}",
+                    fetch_snapshot(name),
+                    inputs=["files"]
+                    + (["last_week_counts"] if name == "last_week" else []),
+                    volatile=True,
+                ),
+                # the snapshot is read again from Parquet, so only its path
+                # is passed between processes
+                Stage(
+                    f"ingest/{name}",
+                    partial(ingest_snapshot, fetched=not skip_fetch),
+                    inputs=[f"fetch/{name}"],
+                    # usually nothing to ingest otherwise
+                    process=not skip_fetch,
+                ),
+            ]
+        ],
+        # snapshots and their summaries are cached, keyed by the Parquet
+        # files ingested above, so reruns which only change the report do
+        # not read them
+        *[
+            Stage(
+                name,
+                partial(read_snapshot, name, SNAPSHOT_COLUMNS[name]),
+                after=[f"ingest/{name}"],
+                fingerprint=[DATA_PATH / f"{name}.parquet"],
+                cache=True,
+            )
+            for name in SNAPSHOTS[:2]
+        ],
+        Stage(
+            "last_week_summary",
+            last_week_summary,
+            inputs=["files"],
+            after=["ingest/last_week", "last_week_counts"],
+            fingerprint=[DATA_PATH / "last_week.parquet"],
+            cache=True,
+        ),
+        Stage("summary", CaseSummary, inputs=["yesterday"], cache=True),
+        Stage(
+            "genomics",
+            lambda df, genome_data: genomics.aggregate(df, genome_data).to_csv(
+                DATA_PATH / "genomics.csv", header=True, index=False
+            ),
+            inputs=["yesterday", "nextstrain"],
+            cache=True,
+            outputs=[DATA_PATH / "genomics.csv"],
+        ),
+        Stage(
+            "age_gender",
+            lambda summary: age_gender(summary).to_csv(
+                DATA_PATH / "age-gender.csv", index=False
+            ),
+            inputs=["summary"],
+            cache=True,
+            outputs=[DATA_PATH / "age-gender.csv"],
+        ),
+        Stage(
+            "store",
+            lambda files, summary: aggregates.save(
+                files["file"], yesterday, daily_counts(summary)
+            ),
+            inputs=["files", "summary"],
+            # counts were stored by the build which cached the stage
+            cache=True,
+        ),
+        Stage(
+            "history",
+            aggregates.history,
+            after=["store", "last_week_summary"],
+            volatile=True,
+        ),
+        Stage(
+            "variables",
+            variables,
+            inputs=[
+                "files",
+                "summary",
+                "day_before_yesterday",
+                "last_week_summary",
+                "nextstrain",
+                "history",
+            ],
+            fingerprint=[overrides, date],
+            cache=True,
+            outputs=[BUILD_PATH / "changes.csv"],
+        ),
+        *[
+            Stage(
+                f"figure/{key}",
+                partial(
+                    figure_variables,
+                    key,
+                    DATA_PATH / "yesterday.parquet",
+                    assets_path=assets_path,
+                ),
+                # keyed by the Parquet file, see the yesterday stage
+                after=["yesterday"],
+                process=True,
+                fingerprint=[external_figures],
+                cache=True,
+                outputs=figure_assets,
+            )
+            for key in PLOTLY_FIGURES
+        ],
+        Stage(
+            "render",
+            render_report,
+            inputs=["variables"] + [f"figure/{key}" for key in PLOTLY_FIGURES],
+            fingerprint=[Path(__file__).parent / "index.html", date],
+            cache=True,
+            outputs=[BUILD_PATH / "index.html", BUILD_PATH / "index.json"],
+        ),
+    ]
+    if not skip_figures:
+        build_stages.append(
+            Stage(
+                "r_figures",
+                r_figures,
+                after=["ingest/yesterday", "genomics", "age_gender"],
+            )
+        )
+
+    timings = {}
     try:
-        var.update(input_files(get_archives_list("csv"), date))
-    except ValueError as e:
-        logging.error(e)
-        sys.exit(1)
-    except ConnectionError as e:
+        _, timings = stages.run(
+            build_stages,
+            cache_path=STAGES_PATH if stage_cache else None,
+            version=code_version(),
+        )
+    except (ValueError, ConnectionError, RuntimeError) as e:
         logging.error(e)
         sys.exit(1)
-
-    if not skip_fetch:
-        logging.info("Fetch yesterday, day before yesterday, and last week's files")
-        var.update(overrides)
-        fetch_urls(
-            [var["file"], var["previous_day_file"], var["last_week_file"]],
-            ["yesterday.csv", "day_before_yesterday.csv", "last_week.csv"],
+    finally:
+        if timings:
+            logging.info(
+                "Critical path: "
+                + " -> ".join(stages.critical_path(build_stages, timings))
+            )
+        if (peak := instrument.max_rss()) > MEMORY_BUDGET:
+            logging.warning(
+                f"Peak memory {peak >> 20} MB exceeded budget of {MEMORY_BUDGET >> 20} MB"
+            )
+        else:
+            logging.info(f"Peak memory {peak >> 20} MB of {MEMORY_BUDGET >> 20} MB")
+        logging.info("Writing stage timings to metrics.json")
+        instrument.write(
+            BUILD_PATH / "metrics.json",
+            {
+                "date": date.isoformat(),
+                "memory_budget_bytes": MEMORY_BUDGET,
+                "stages": {
+                    name: {"start": round(start, 3), "end": round(end, 3)}
+                    for name, (start, end) in timings.items()
+                },
+            },
         )
-    df = pd.read_csv(DATA_PATH / "yesterday.csv")
-    prev_df = pd.read_csv(DATA_PATH / "day_before_yesterday.csv")
-    last_week_df = pd.read_csv(DATA_PATH / "last_week.csv")
 
+
+def build_archive(
+    date: datetime.date,
+    files: dict[str, str],
+    snapshots: tuple[Path, Path, Path],
+    nextstrain_file: Path,
+    overrides: dict[str, Any],
+    history: pd.DataFrame,
+):
+    """Writes build/<date>/index.json from snapshot Parquet files
+
+    Run in backfill worker processes; snapshots are loaded once per process,
+    so consecutive dates sharing a snapshot do not read it again. Also writes
+    genomics and age-gender data for the figures to
+    DATA_PATH/genomics/<date>.csv and DATA_PATH/age-gender/<date>.csv
+
+    history: Stored confirmed cases, as returned by aggregates.history()
+      once the counts of every backfilled date are stored, see store_counts()
+    """
+    import figures.genomics as genomics
+
+    logging.info(f"Building report variables for {date}")
+    _, _, last_week = get_compare_days(date)
+    df, prev_df = (
+        load_snapshot(file, name) for name, file in zip(SNAPSHOTS[:2], snapshots[:2])
+    )
+    last_week_summary = stored_summary(
+        files["last_week_file"],
+        last_week,
+        lambda: load_snapshot(snapshots[2], "last_week"),
+    )
+    genome_data = read_nextstrain(nextstrain_file)
     genomics.aggregate(df, genome_data).to_csv(
-        DATA_PATH / "genomics.csv",
-        header=True,
-        index=False,
+        DATA_PATH / "genomics" / f"{date}.csv", header=True, index=False
     )
+    summary = CaseSummary(df)
+    age_gender(summary).to_csv(
+        DATA_PATH / "age-gender" / f"{date}.csv", header=True, index=False
+    )
+    var = {
+        **files,
+        **report_variables(
+            date,
+            summary,
+            prev_df,
+            last_week_summary,
+            genome_data,
+            history=history,
+        ),
+        **overrides,
+    }
+    (archive_path := BUILD_PATH / date.isoformat()).mkdir(exist_ok=True)
+    write_variables(var, archive_path / "index.json")
 
-    var.update(counts(df, prev_df))
-    var.update(table_confirmed_cases(df, last_week_df))
-    var.update(travel_history(df))
-    var.update(demographics(df))
-    var.update(delay_suspected_to_confirmed(df))
-    var.update(overrides)
-    var.update(render_figure(choropleth.figure(df), "embed_choropleth"))
-    var.update(render_figure(choropleth.figure_counts(df), "embed_counts"))
 
-    # remove these for now
-    del var["text_travel_history"]
-    logging.info("Rendering index.html")
+def store_counts(jobs: list[tuple[datetime.date, str, Path]]):
+    """Stores daily counts of snapshots not yet in the aggregate store
 
-    render(Path(__file__).parent / "index.html", var, BUILD_PATH / "index.html")
+    jobs: Report date, and URL and Parquet file of its snapshot
+    """
+    for date, file, snapshot in jobs:
+        if aggregates.load(file) is None:
+            yesterday, _, _ = get_compare_days(date)
+            summary = CaseSummary(read_columns(snapshot, SNAPSHOT_COLUMNS["last_week"]))
+            aggregates.save(file, yesterday, daily_counts(summary))
 
-    logging.info("Writing variables to index.json")
-    with (BUILD_PATH / "index.json").open("w") as fp:
-        json.dump(
-            {k: v for k, v in var.items() if not k.startswith("embed_")},
-            fp,
-            indent=2,
-            sort_keys=True,
+
+def backfill(
+    fetch_bucket: str,
+    start: datetime.date,
+    end: datetime.date,
+    skip_fetch: bool = False,
+    skip_figures: bool = False,
+    overrides_file: str = "overrides.yml",
+    workers: Optional[int] = None,
+    figure_workers: Optional[int] = None,
+    figure_timeout: int = 600,
+):
+    """Build report variables for every working day from start to end inclusive
+
+    Needed snapshots are resolved from a single archive listing, and each is
+    fetched and ingested once. The counts of every date are stored first, so
+    trends of each date do not depend on which dates were built before it.
+    Dates are then built in a process pool,
+    writing build/<date>/index.json for each date. Figures for all dates are
+    rendered by a single pool of R workers, written to build/<date>/figures
+    """
+    import figures.render
+
+    overrides = load_overrides(overrides_file)
+    links = get_archives_list("csv")
+    files = {}
+    for date in working_days(start, end):
+        try:
+            files[date] = input_files(links, date, overrides.get(date, {}))
+        except ValueError:
+            logging.error(f"Skipping {date}, input files not found")
+    urls = sorted({url for date_files in files.values() for url in date_files.values()})
+    logging.info(f"Fetching {len(urls)} snapshots for {len(files)} reports")
+    snapshots = fetch_snapshots(urls, skip_fetch)
+
+    (nextstrain_path := DATA_PATH / "nextstrain").mkdir(exist_ok=True)
+    (DATA_PATH / "genomics").mkdir(exist_ok=True)
+    (DATA_PATH / "age-gender").mkdir(exist_ok=True)
+    nextstrain_files = {date: nextstrain_path / f"{date}.tsv" for date in files}
+    if not skip_fetch:
+        logging.info("Fetch nextstrain data from S3")
+        with ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+            list(
+                pool.map(
+                    lambda date: fetch_nextstrain(
+                        fetch_bucket, date, nextstrain_files[date]
+                    ),
+                    files,
+                )
+            )
+
+    workers = workers or os.cpu_count()
+    count_jobs = [
+        (date, files[date]["file"], snapshots[files[date]["file"]]) for date in files
+    ]
+    with ProcessPoolExecutor(workers) as pool:
+        for _ in pool.map(store_counts, chunks(count_jobs, workers)):
+            pass
+    history = aggregates.history()
+
+    jobs = [
+        (
+            date,
+            files[date],
+            tuple(snapshots[url] for url in files[date].values()),
+            nextstrain_files[date],
+            overrides.get(date, {}),
+            history,
         )
+        for date in files
+    ]
+    with ProcessPoolExecutor(workers) as pool:
+        # contiguous chunks of dates share snapshots within a worker
+        for _ in pool.map(build_archive_chunk, chunks(jobs, workers)):
+            pass
 
     if not skip_figures:
-        for figure in FIGURES:
-            logging.info(f"Generating figure {figure}")
-            subprocess.run(["Rscript", f"src/figures/{figure}.r"])
+        figure_jobs = [
+            (
+                figure,
+                figures.render.figure_env(
+                    BUILD_PATH / date.isoformat() / "figures",
+                    LINE_LIST=cache.path(files[date]["file"]),
+                    GENOMICS_DATA=DATA_PATH / "genomics" / f"{date}.csv",
+                    AGE_GENDER_DATA=DATA_PATH / "age-gender" / f"{date}.csv",
+                ),
+            )
+            for date in files
+            for figure in FIGURES
+        ]
+        with figures.render.RWorkerPool(figure_workers or workers) as pool:
+            figures.render.render_jobs(figure_jobs, pool, timeout=figure_timeout)
+
+
+def chunks(items: list, n: int) -> list[list]:
+    """Splits items into at most n contiguous chunks of similar size"""
+    size = -(-len(items) // n) if items else 1
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def build_archive_chunk(jobs: list[tuple]):
+    """Runs build_archive() for a chunk of dates in a worker process"""
+    for job in jobs:
+        build_archive(*job)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Build Monkeypox epidemiology report")
     parser.add_argument("bucket", help="S3 bucket to fetch genomics data from")
     parser.add_argument("--date", help="Build report for date instead of today")
+    parser.add_argument(
+        "--from",
+        dest="start",
+        help="Backfill report variables for working days starting from this date",
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        help="Last date to backfill when using --from, defaults to today",
+    )
+    parser.add_argument(
+        "--workers", help="Number of backfill worker processes", type=int
+    )
     parser.add_argument(
         "--skip-fetch", help="Skip data fetch and use cached files", action="store_true"
     )
@@ -457,13 +1631,61 @@ if __name__ == "__main__":
     parser.add_argument(
         "--overrides", help="Specify overrides file", default="overrides.yml"
     )
-    args = parser.parse_args()
-    build(
-        args.bucket,
-        date=datetime.datetime.fromisoformat(args.date).date()
-        if args.date
-        else datetime.datetime.today().date(),
-        skip_fetch=args.skip_fetch,
-        skip_figures=args.skip_figures,
-        overrides_file=args.overrides,
+    parser.add_argument(
+        "--external-figures",
+        help="Write Plotly figures to compressed assets instead of inlining them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-stage-cache",
+        help=f"Run every build stage instead of reusing results in {STAGES_PATH}",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--figure-workers", help="Number of figures to render at once", type=int
+    )
+    parser.add_argument(
+        "--profile",
+        help=f"Trace memory allocations and write a cProfile profile to {PROFILE_FILE}",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--figure-timeout",
+        help="Timeout in seconds for rendering each figure",
+        type=int,
+        default=600,
     )
+    args = parser.parse_args()
+    if args.start:
+        backfill(
+            args.bucket,
+            datetime.datetime.fromisoformat(args.start).date(),
+            datetime.datetime.fromisoformat(args.end).date() if args.end else today,
+            skip_fetch=args.skip_fetch,
+            skip_figures=args.skip_figures,
+            overrides_file=args.overrides,
+            workers=args.workers,
+            figure_workers=args.figure_workers,
+            figure_timeout=args.figure_timeout,
+        )
+        sys.exit(0)
+    instrument.start(trace_memory=args.profile, profile=args.profile)
+    try:
+        # stages profile themselves in their threads and processes
+        with instrument.profile():
+            build(
+                args.bucket,
+                date=datetime.datetime.fromisoformat(args.date).date()
+                if args.date
+                else datetime.datetime.today().date(),
+                skip_fetch=args.skip_fetch,
+                skip_figures=args.skip_figures,
+                overrides_file=args.overrides,
+                figure_workers=args.figure_workers,
+                figure_timeout=args.figure_timeout,
+                external_figures=args.external_figures,
+                stage_cache=not args.no_stage_cache,
+            )
+    finally:
+        if instrument.write_profile(PROFILE_FILE):
+            logging.info(f"Wrote profile to {PROFILE_FILE}, view with snakeviz")
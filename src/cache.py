@@ -0,0 +1,76 @@
+"""
+Local content-addressed cache of archive snapshots
+
+Archive files in the data repository never change once published, so
+they are stored by a hash of their URL and reused by later builds.
+The cache is bounded in size, evicting least recently used files first.
+"""
+import os
+import shutil
+import logging
+import hashlib
+from typing import Optional
+from pathlib import Path
+
+CACHE_PATH = Path(
+    os.getenv("MONKEYPOX_CACHE", Path.home() / ".cache" / "monkeypox-report")
+)
+CACHE_MAX_BYTES = int(os.getenv("MONKEYPOX_CACHE_MAX_BYTES", 4 * 1024**3))
+
+
+def key(url: str) -> str:
+    "Return cache key for a URL"
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def path(url: str) -> Path:
+    "Return path where a URL is cached"
+    return CACHE_PATH / (k := key(url))[:2] / k
+
+
+def get(url: str) -> Optional[Path]:
+    "Return cached file for a URL if present, marking it as recently used"
+    if (file := path(url)).exists():
+        os.utime(file)
+        return file
+    return None
+
+
+def copy(file: Path, destination: Path):
+    "Copy cached file to destination, hard linking where possible"
+    partial = destination.with_name(f".{destination.name}.part")
+    partial.unlink(missing_ok=True)
+    try:
+        os.link(file, partial)
+    except OSError:
+        shutil.copyfile(file, partial)
+    os.replace(partial, destination)
+
+
+def files() -> list[Path]:
+    "Return cached files, least recently used first"
+    if not CACHE_PATH.exists():
+        return []
+    return sorted(
+        (f for f in CACHE_PATH.glob("*/*") if not f.name.startswith(".")),
+        key=lambda f: f.stat().st_mtime,
+    )
+
+
+def evict(max_bytes: int = CACHE_MAX_BYTES, keep: list[str] = []):
+    """Remove least recently used files until cache is within max_bytes
+
+    keep: URLs whose files, and files derived from them such as Parquet
+      snapshots, are not removed, as they are in use
+    """
+    kept = {key(url) for url in keep}
+    cached = [(f, f.stat().st_size) for f in files()]
+    size = sum(s for _, s in cached)
+    for file, file_size in cached:
+        if size <= max_bytes:
+            break
+        if file.name.split(".")[0] in kept:
+            continue
+        logging.info(f"Evicting {file.name} from cache")
+        file.unlink(missing_ok=True)
+        size -= file_size
@@ -2,23 +2,24 @@ import random
 from pathlib import Path
 from typing import Optional
 
-import pycountry
 import pandas as pd
-import geopandas as gpd
-import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
 
 import logging
 
+import country_names
+
 random.seed(0)
 
-alpha_3 = {
-    country.alpha_3: getattr(country, "common_name", None) or country.name
-    for country in pycountry.countries
-}
+# ISO 3166 alpha-3 codes with names and centroids, generated by
+# running this file, which requires pycountry and geopandas
+COUNTRIES_FILE = country_names.COUNTRIES_FILE
 
 TRAVEL_HISTORY_LINEWIDTH = 0.9
+MAX_TRAVEL_ROUTES = 1000
+
+# travel routes are drawn with wider lines for routes with more cases,
+# as (minimum number of cases, line width multiplier)
+TRAVEL_ROUTE_WIDTHS = [(1, 1), (5, 2), (20, 3)]
 
 BINS = [-1, 0, 9, 100, 500, 2000, 5000]
 COLORS = [
@@ -31,23 +32,14 @@ COLORS = [
     "rgb(34, 88, 147)",  # >5000
 ]
 
-COUNTRY_QUIRKS = {
-    "england": "GBR",
-    "scotland": "GBR",
-    "wales": "GBR",
-    "northern ireland": "GBR",
-    "uae": "ARE",
-}
-
-# replace general locations with approximate countries
-TRAVEL_HISTORY_QUIRKS = {
-    "Africa": "Mali",  # middle-ish of West Africa
-    "Gran Canaria": "Spain",
-    "Canary Islands": "Spain",
-    "Europe": "Luxembourg",  # middle-ish of Europe
-    "Western Europe": "Luxembourg",
-    "West Africa": "Mali",
-}
+
+def _alpha_3() -> dict[str, str]:
+    import pycountry
+
+    return {
+        country.alpha_3: getattr(country, "common_name", None) or country.name
+        for country in pycountry.countries
+    }
 
 
 def _centroids():
@@ -61,15 +53,26 @@ def _centroids():
         .set_index("iso_a3")
         .rename({0: "centroid"}, axis=1)
     )
-    return centroid_list.assign(
+    centroids = centroid_list.assign(
         longitude=centroid_list.centroid.map(lambda point: point.x),
         latitude=centroid_list.centroid.map(lambda point: point.y),
     )[["latitude", "longitude"]]
+    centroids.loc["SGP"] = 1.28992, 103.85097
+    centroids.loc["UAE"] = 23.991, 53.987
+    return centroids[centroids.index != "-99"]
+
 
+def write_countries(file: Path = COUNTRIES_FILE):
+    "Write country names and centroids by ISO 3166 alpha-3 code to file"
+    names = pd.Series(_alpha_3(), name="name")
+    pd.concat([names, _centroids().round(6)], axis=1).rename_axis(
+        "iso_a3"
+    ).sort_index().to_csv(file)
 
-centroids = _centroids()
-centroids.loc["SGP"] = 1.28992, 103.85097
-centroids.loc["UAE"] = 23.991, 53.987
+
+countries = pd.read_csv(COUNTRIES_FILE, index_col="iso_a3", keep_default_na=False)
+alpha_3 = country_names.NAMES
+centroids = countries[countries.latitude != ""][["latitude", "longitude"]].astype(float)
 centroids_dict = centroids.to_dict()
 
 
@@ -91,14 +94,7 @@ def interval_str(interval: pd.Interval) -> str:
 
 
 def get_iso_alpha_3(country: str) -> Optional[str]:
-    country = country.lower()
-    try:
-        return (
-            COUNTRY_QUIRKS.get(country) or pycountry.countries.lookup(country).alpha_3
-        )
-    except LookupError as e:
-        logging.error(e)
-        return None
+    return country_names.iso3(country)
 
 
 def counts(data: pd.DataFrame) -> pd.DataFrame:
@@ -144,40 +140,66 @@ def singleton_list(x):
 
 
 def travel_history(data: pd.DataFrame) -> pd.DataFrame:
+    """Returns travel routes of confirmed cases with travel history
+
+    Indexed by route, a tuple of ISO3 codes of the travel history countries
+    followed by the country reporting the case, with columns list of
+    travel history entry dates, len of number of cases, and Travel_route
+    with country names along the route.
+
+    Routes only depend on the travel history and reporting country, so they
+    are computed once for each distinct pair and mapped to cases by integer IDs.
+    """
     data = data[(data.Status == "confirmed") & ~pd.isna(data.Travel_history_country)]
-    data = data.assign(
-        Travel_history_country=data.Travel_history_country.replace(
-            TRAVEL_HISTORY_QUIRKS
-        ).map(lambda s: [k.strip() for k in s.replace(",", ";").split(";")])
-    )
-    data = data.assign(
-        Travel_history_country_ISO3=data.Travel_history_country.map(
-            lambda countries: tuple(map(get_iso_alpha_3, countries))
-        )
+    pair_id, pairs = pd.factorize(
+        data.Travel_history_country.astype(str)
+        + "\t"
+        + data.Country_ISO3.astype(object).fillna("")
+    )
+    pairs = pd.Series(pairs).str.split("\t", n=1, expand=True)
+    travel_history_country, country_iso3 = pairs[0], pairs[1]
+
+    destinations_iso3 = country_names.to_iso3(
+        travel_history_country.str.replace(",", ";", regex=False)
+        .str.split(";")
+        .explode()
     )
+
     # remove cases where travel country is same as country reported
-    data = data[
-        data.apply(
-            lambda row: row.Country_ISO3 not in row.Travel_history_country_ISO3, axis=1
-        )
-    ]
-    # add country where case is reported to list
+    same_country = (
+        (destinations_iso3 == country_iso3.reindex(destinations_iso3.index))
+        .groupby(level=0)
+        .any()
+    )
+
+    # add country where case is reported to route
+    pair_routes = (
+        destinations_iso3.groupby(level=0).agg(list) + country_iso3.map(singleton_list)
+    ).map(lambda codes: tuple(code or None for code in codes))
+    route_id, routes = pd.factorize(pair_routes.where(~same_country))
+    case_route_id = route_id[pair_id]
+    has_route = case_route_id >= 0
+
     th = (
-        data.assign(
-            Travel_route_ISO3=(
-                data.Travel_history_country_ISO3.map(list)
-                + data.Country_ISO3.map(singleton_list)
-            ).map(tuple)
-        )
-        .groupby("Travel_route_ISO3")
-        .Travel_history_entry.agg([list, len])
+        data.Travel_history_entry[has_route]
+        .groupby(case_route_id[has_route])
+        .agg([list, len])
+    )
+    th.index = pd.Index(
+        [routes[i] for i in th.index], tupleize_cols=False, name="Travel_route_ISO3"
     )
     th = th.assign(list=th.list.map(lambda xs: [x for x in xs if isinstance(x, str)]))
-    th = th.assign(Travel_route=th.index.map(lambda xs: list(filter(None, [alpha_3.get(x) for x in xs]))))
+    th = th.assign(
+        Travel_route=th.index.map(
+            lambda xs: list(filter(None, [alpha_3.get(x) for x in xs]))
+        )
+    )
     return th
 
 
 def figure(data: pd.DataFrame):
+    import plotly.express as px
+
     df = counts(data)
     th = travel_history(data)
     binned_counts = (
@@ -203,23 +225,60 @@ def figure(data: pd.DataFrame):
             showframe=False, showcoastlines=False, projection_type="equirectangular"
         ),
     )
-    for row in th.itertuples():
-        fig.add_trace(
-            go.Scattergeo(
-                lon=travel_history_coords(row.Index, "longitude"),
-                lat=travel_history_coords(row.Index, "latitude"),
-                name=" ➔ ".join(row.Travel_route) + "<br>" + "<br>".join(row.list),
-                mode="lines",
-                line=dict(width=TRAVEL_HISTORY_LINEWIDTH, color="#505050"),
-            )
-        )
-    fig.update_traces(
-        showlegend=False, hovertemplate=" ", selector=dict(type="scattergeo")
-    )
+    for trace in travel_route_traces(th):
+        fig.add_trace(trace)
     return fig
 
 
+def travel_route_traces(th: pd.DataFrame, max_routes: int = MAX_TRAVEL_ROUTES):
+    """Returns Scattergeo traces drawing travel routes from travel_history()
+
+    Routes are batched into one trace for each line width in
+    TRAVEL_ROUTE_WIDTHS, with gaps between routes and hover text for each
+    route. Only the max_routes routes with the most cases are drawn.
+    """
+    import plotly.graph_objects as go
+
+    if len(th) > max_routes:
+        logging.info(f"Drawing {max_routes} of {len(th)} travel routes")
+        th = th.sort_values("len", ascending=False, kind="stable").head(max_routes)
+    width_class = pd.cut(
+        th.len,
+        bins=[n for n, _ in TRAVEL_ROUTE_WIDTHS] + [float("inf")],
+        labels=[width for _, width in TRAVEL_ROUTE_WIDTHS],
+        right=False,
+    )
+    traces = []
+    for width in TRAVEL_ROUTE_WIDTHS:
+        lon, lat, text = [], [], []
+        for row in th[width_class == width[1]].itertuples():
+            route_lon = travel_history_coords(row.Index, "longitude")
+            route_lat = travel_history_coords(row.Index, "latitude")
+            label = " ➔ ".join(row.Travel_route) + "<br>" + "<br>".join(row.list)
+            lon.extend(route_lon + [None])
+            lat.extend(route_lat + [None])
+            text.extend([label] * len(route_lon) + [None])
+        if lon:
+            traces.append(
+                go.Scattergeo(
+                    lon=lon,
+                    lat=lat,
+                    text=text,
+                    mode="lines",
+                    line=dict(
+                        width=width[1] * TRAVEL_HISTORY_LINEWIDTH, color="#505050"
+                    ),
+                    hovertemplate="%{text}<extra></extra>",
+                    showlegend=False,
+                )
+            )
+    return traces
+
+
 def figure_counts(data: pd.DataFrame):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
     cca = cumulative_counts(data)
     cco = cumulative_countries(data)
 
@@ -251,5 +310,11 @@ def figure_counts(data: pd.DataFrame):
 def travel_history_coords(countries: list[str], key: str) -> list[float]:
     MAX = {"latitude": 90, "longitude": 180}
     return [
-        min(centroids_dict[key][c] + 2 * random.random(), MAX[key]) for c in countries if c is not None
+        min(centroids_dict[key][c] + 2 * random.random(), MAX[key])
+        for c in countries
+        if c is not None
     ]
+
+
+if __name__ == "__main__":
+    write_countries()
@@ -0,0 +1,120 @@
+"""
+Country name normalisation shared by the choropleth and genomics code
+
+Free text country names are resolved to ISO 3166 alpha-3 codes through a
+single index, which is memoized and kept between runs in NAMES_FILE, so
+pycountry is only consulted for names not seen before.
+"""
+import os
+import json
+import logging
+import hashlib
+import threading
+import importlib.metadata
+from pathlib import Path
+from typing import Final, Optional
+
+import pandas as pd
+
+NAMES_FILE: Final = Path(__file__).parent / "data" / "country_names.json"
+COUNTRIES_FILE: Final = Path(__file__).parent / "countries.csv"
+
+# names (lowercase) not resolved by pycountry, or resolved to a different
+# country than intended, mapped to ISO3 codes
+QUIRKS: Final = {
+    "england": "GBR",
+    "scotland": "GBR",
+    "wales": "GBR",
+    "northern ireland": "GBR",
+    "uae": "ARE",
+    "usa": "USA",
+    # general locations in travel history, replaced with approximate countries
+    "africa": "MLI",  # middle-ish of West Africa
+    "west africa": "MLI",
+    "gran canaria": "ESP",
+    "canary islands": "ESP",
+    "europe": "LUX",  # middle-ish of Europe
+    "western europe": "LUX",
+}
+
+# country names by ISO3 code, see choropleth.write_countries()
+_countries = pd.read_csv(COUNTRIES_FILE, index_col="iso_a3", keep_default_na=False)
+NAMES: Final = _countries.name[_countries.name != ""].to_dict()
+
+_index: Optional[dict[str, Optional[str]]] = None
+_reported_misses: set[str] = set()
+# build stages resolve names concurrently, see stages.py
+_lock = threading.RLock()
+
+
+def _version() -> str:
+    "Version of the index, which changes with QUIRKS and the pycountry data"
+    return hashlib.sha256(
+        json.dumps([QUIRKS, importlib.metadata.version("pycountry")]).encode()
+    ).hexdigest()
+
+
+def _load() -> dict[str, Optional[str]]:
+    global _index
+    if _index is None:
+        _index = {}
+        try:
+            stored = json.loads(NAMES_FILE.read_text())
+            if stored["version"] == _version():
+                _index = stored["names"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+    return _index
+
+
+def _save():
+    "Writes the index, replacing NAMES_FILE at once as processes may read it"
+    NAMES_FILE.parent.mkdir(exist_ok=True)
+    partial = NAMES_FILE.with_name(f".{NAMES_FILE.name}.{os.getpid()}.part")
+    partial.write_text(
+        json.dumps({"version": _version(), "names": _load()}, indent=2, sort_keys=True)
+    )
+    os.replace(partial, NAMES_FILE)
+
+
+def _lookup(name: str) -> Optional[str]:
+    import pycountry
+
+    if name in QUIRKS:
+        return QUIRKS[name]
+    try:
+        return pycountry.countries.lookup(name).alpha_3
+    except LookupError:
+        return None
+
+
+def to_iso3(names: pd.Series) -> pd.Series:
+    """Returns ISO3 codes for a series of country names, None if not found
+
+    Each distinct name is only looked up once, and names that are not
+    found are reported once.
+    """
+    keys = names.astype(object).where(names.notna()).str.strip().str.lower()
+    with _lock:
+        index = _load()
+        if new := [k for k in keys.dropna().unique() if k not in index]:
+            index.update({k: _lookup(k) for k in new})
+            _save()
+        iso3 = keys.map(index)
+        if misses := sorted(
+            set(names[iso3.isna() & keys.notna()].astype(str).str.strip())
+            - _reported_misses
+        ):
+            logging.warning(f"Country names not found: {', '.join(misses)}")
+            _reported_misses.update(misses)
+    return iso3.astype(object).where(lambda s: s.notna(), None)
+
+
+def iso3(name: str) -> Optional[str]:
+    "Returns ISO3 code for a country name, None if not found"
+    return to_iso3(pd.Series([name]))[0]
+
+
+def standardise(names: pd.Series) -> pd.Series:
+    "Returns standard country names, keeping names that are not found"
+    return to_iso3(names).map(NAMES).fillna(names)
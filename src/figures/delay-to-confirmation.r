@@ -6,7 +6,7 @@ library(RColorBrewer)
 library(dplyr)
 
 
-gh_data <- read.csv('src/data/yesterday.csv')
+gh_data <- read.csv(Sys.getenv('LINE_LIST', 'src/data/yesterday.csv'))
 gh_data$Date_confirmation <- strptime(gh_data$Date_confirmation, format = "%Y-%m-%d")
 gh_data$Date_entry <- strptime(gh_data$Date_entry, format = "%Y-%m-%d")
 
@@ -56,7 +56,7 @@ delay_fig <- ggplot(gh_data_delay) +
   annotate("text", x = med, y = hist_max, label = paste("Suspected \u2192 Confirmed:", nrow(gh_data_delay)), hjust=-0.05) +
   scale_x_continuous(n.breaks = 10)
 
-png("build/figures/delay-to-confirmation.png",
+png(file.path(Sys.getenv("FIGURES_PATH", "build/figures"), "delay-to-confirmation.png"),
     width=20, height=15, units="cm", res=500)
 print(delay_fig)
 dev.off()
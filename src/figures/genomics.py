@@ -12,11 +12,12 @@ from pathlib import Path
 
 import pandas as pd
 
+import country_names
 
-def aggregate(gh_data: pd.DataFrame, genome_data: pd.DataFrame) -> pd.DataFrame:
 
+def aggregate(gh_data: pd.DataFrame, genome_data: pd.DataFrame) -> pd.DataFrame:
     genome_data = genome_data.assign(
-        country=genome_data.country.replace("USA", "United States")
+        country=country_names.standardise(genome_data.country)
     ).rename(columns={"country": "Country"})
 
     genome_agg = (
@@ -30,11 +31,9 @@ def aggregate(gh_data: pd.DataFrame, genome_data: pd.DataFrame) -> pd.DataFrame:
     con_cases = gh_data[
         (gh_data.Status == "confirmed") & (gh_data.ID.str.startswith("N"))
     ].reset_index(drop=True)
-    con_cases["Country"] = con_cases.Country.replace(
-        ["England", "Scotland", "Wales", "Northern Ireland"], "United Kingdom"
-    )
+    con_cases["Country"] = country_names.standardise(con_cases.Country)
     agg_con_cases = (
-        con_cases.groupby("Country")
+        con_cases.groupby("Country", observed=True)
         .size()
         .reset_index(name="Gh_confirmed_cases")
         .sort_values(by="Gh_confirmed_cases", ascending=False)
@@ -1,6 +1,6 @@
 library(ggpubr)
 
-agg_df <- read.csv("src/data/genomics.csv")
+agg_df <- read.csv(Sys.getenv("GENOMICS_DATA", "src/data/genomics.csv"))
 
 fig1 <- ggscatter(agg_df, x = "nextstrain_genome_count", y = "Gh_confirmed_cases", 
                   color="#007AEC",
@@ -14,7 +14,7 @@ fig1 <- ggscatter(agg_df, x = "nextstrain_genome_count", y = "Gh_confirmed_cases
   coord_cartesian(clip = 'off') +
   theme(text = element_text(colour = "black"))
 
-png("build/figures/genomics.png",
+png(file.path(Sys.getenv("FIGURES_PATH", "build/figures"), "genomics.png"),
     width=15, height=15, units="cm", res=500)
 print(fig1)
 dev.off()
@@ -0,0 +1,256 @@
+"""
+Render R figures concurrently
+
+Figures are rendered by long-lived R worker sessions (worker.r), which load
+the plotting libraries once and render every figure requested over a
+pipe, so each figure only pays for its own plotting.
+
+Each figure records a fingerprint of its script and input data when
+rendered, and is skipped on later runs if the fingerprint is unchanged
+and the figure already exists.
+"""
+import json
+import queue
+import logging
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Final, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+
+ROOT: Final = Path(__file__).parent.parent.parent
+FIGURES_PATH: Final = ROOT / "build" / "figures"
+FINGERPRINTS_FILE: Final = ROOT / "src" / "data" / "figures.json"
+WORKER_SCRIPT: Final = Path(__file__).parent / "worker.r"
+WORKER_REPLY: Final = "@figure-worker"
+DEFAULT_TIMEOUT: Final = 600  # seconds
+
+# default data files read by figure scripts, set as environment variables
+DEFAULT_ENV: Final = {
+    "LINE_LIST": ROOT / "src" / "data" / "yesterday.csv",
+    "GENOMICS_DATA": ROOT / "src" / "data" / "genomics.csv",
+    "AGE_GENDER_DATA": ROOT / "src" / "data" / "age-gender.csv",
+}
+
+# environment variables naming the data files read by each figure script
+FIGURE_INPUTS: Final = {
+    "delay-to-confirmation": ["LINE_LIST"],
+    "genomics": ["GENOMICS_DATA"],
+    "age-gender": ["AGE_GENDER_DATA"],
+    "travel-history": ["LINE_LIST"],
+}
+
+
+class RWorker:
+    "Long-lived R session that renders figures requested over a pipe"
+
+    command = ["Rscript", str(WORKER_SCRIPT.relative_to(ROOT))]
+
+    def __init__(self):
+        self.process: Optional[subprocess.Popen] = None
+        self.replies: queue.Queue[str] = queue.Queue()
+
+    def _read_replies(self, process: subprocess.Popen, replies: queue.Queue):
+        for line in process.stdout:
+            if line.startswith(WORKER_REPLY):
+                replies.put(line.rstrip("\n").split("\t", 2)[1:])
+        replies.put(None)  # worker exited
+
+    def _reply(self, timeout: int) -> list[str]:
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            self.close()
+            raise TimeoutError
+        if reply is None:
+            self.close()
+            raise RuntimeError("R figure worker exited unexpectedly")
+        return reply
+
+    def start(self, timeout: int = DEFAULT_TIMEOUT):
+        "Start R session and wait for libraries to load"
+        logging.info("Starting R figure worker")
+        self.replies = queue.Queue()
+        self.process = subprocess.Popen(
+            self.command,
+            cwd=ROOT,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        threading.Thread(
+            target=self._read_replies, args=(self.process, self.replies), daemon=True
+        ).start()
+        self._reply(timeout)  # ready
+
+    def render(self, script: Path, env: dict[str, str], timeout: int):
+        "Render figure script, raising RuntimeError on failure"
+        if self.process is None or self.process.poll() is not None:
+            self.start(timeout)
+        request = "\t".join(
+            [str(script.relative_to(ROOT))] + [f"{k}={v}" for k, v in env.items()]
+        )
+        self.process.stdin.write(request + "\n")
+        self.process.stdin.flush()
+        status, *message = self._reply(timeout)
+        if status != "ok":
+            raise RuntimeError("\n".join(message))
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+
+class RWorkerPool:
+    "Pool of R figure workers, started on first use and reused across figures"
+
+    def __init__(self, size: int = 1):
+        self.size = size
+        self.workers: queue.Queue[RWorker] = queue.Queue()
+        for _ in range(size):
+            self.workers.put(RWorker())
+
+    @contextmanager
+    def worker(self):
+        worker = self.workers.get()
+        try:
+            yield worker
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        for _ in range(self.size):
+            self.workers.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def script(figure: str) -> Path:
+    "Return path to R script for figure"
+    return ROOT / "src" / "figures" / f"{figure}.r"
+
+
+def fingerprint(figure: str, env: dict[str, str]) -> str:
+    "Return hash of figure script and input data"
+    sha = hashlib.sha256()
+    for file in [script(figure)] + [
+        Path(env[k]) for k in FIGURE_INPUTS.get(figure, [])
+    ]:
+        sha.update(file.name.encode("utf-8"))
+        with file.open("rb") as fp:
+            while chunk := fp.read(1 << 20):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_fingerprints() -> dict[str, str]:
+    if not FINGERPRINTS_FILE.exists():
+        return {}
+    return json.loads(FINGERPRINTS_FILE.read_text())
+
+
+def render(
+    pool: RWorkerPool, figure: str, env: dict[str, str], timeout: int = DEFAULT_TIMEOUT
+):
+    "Render figure on a worker from pool, raising RuntimeError on failure or timeout"
+    logging.info(f"Generating figure {figure}")
+    with pool.worker() as worker, instrument.span(f"figure/{figure}"):
+        try:
+            worker.render(script(figure), env, timeout)
+        except TimeoutError:
+            raise RuntimeError(f"Figure {figure} timed out after {timeout} seconds")
+        except RuntimeError as e:
+            raise RuntimeError(f"Figure {figure} failed: {e}")
+
+
+def figure_env(figures_path: Path = FIGURES_PATH, **inputs: Path) -> dict[str, str]:
+    """Return environment for figure scripts
+
+    figures_path: Folder to write figures to
+    inputs: Data files to use instead of DEFAULT_ENV, such as LINE_LIST
+    """
+    return {
+        k: str(v)
+        for k, v in {**DEFAULT_ENV, **inputs, "FIGURES_PATH": figures_path}.items()
+    }
+
+
+def render_jobs(
+    jobs: list[tuple[str, dict[str, str]]],
+    pool: Optional[RWorkerPool] = None,
+    timeout: int = DEFAULT_TIMEOUT,
+    force: bool = False,
+):
+    """Render figures concurrently, skipping figures that are current
+
+    jobs: List of (figure, environment) to render, see figure_env()
+    pool: R workers to render figures with, if not specified, a pool with
+      a worker per figure is used
+    timeout: Timeout in seconds for each figure
+    force: Render figures even if they are current
+    """
+    fingerprints = read_fingerprints()
+
+    def key(figure: str, env: dict[str, str]) -> str:
+        return str(Path(env["FIGURES_PATH"]) / f"{figure}.png")
+
+    if not force and (
+        current := [
+            (f, env)
+            for f, env in jobs
+            if Path(key(f, env)).exists()
+            and fingerprints.get(key(f, env)) == fingerprint(f, env)
+        ]
+    ):
+        logging.info(f"Skipping {len(current)} current figures")
+        jobs = [job for job in jobs if job not in current]
+
+    for _, env in jobs:
+        Path(env["FIGURES_PATH"]).mkdir(parents=True, exist_ok=True)
+    owned_pool = pool is None
+    pool = pool or RWorkerPool(max(len(jobs), 1))
+    failed = []
+    try:
+        with ThreadPoolExecutor(pool.size) as executor:
+            futures = [
+                (f, env, executor.submit(render, pool, f, env, timeout))
+                for f, env in jobs
+            ]
+            for figure, env, future in futures:
+                try:
+                    future.result()
+                    fingerprints[key(figure, env)] = fingerprint(figure, env)
+                except RuntimeError as e:
+                    logging.error(e)
+                    failed.append(key(figure, env))
+    finally:
+        if owned_pool:
+            pool.close()
+    FINGERPRINTS_FILE.parent.mkdir(exist_ok=True)
+    FINGERPRINTS_FILE.write_text(json.dumps(fingerprints, indent=2, sort_keys=True))
+    if failed:
+        raise RuntimeError(f"Failed to generate figures: {', '.join(failed)}")
+
+
+def render_figures(
+    figures: list[str],
+    pool: Optional[RWorkerPool] = None,
+    timeout: int = DEFAULT_TIMEOUT,
+    force: bool = False,
+    figures_path: Path = FIGURES_PATH,
+    **inputs: Path,
+):
+    """Render figures from the same data, see render_jobs() and figure_env()"""
+    env = figure_env(figures_path, **inputs)
+    render_jobs([(f, env) for f in figures], pool, timeout, force)
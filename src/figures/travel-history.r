@@ -39,7 +39,7 @@ country2long <- function(x) {
 
 
 
-MPXV_cases_data <- read.csv("src/data/yesterday.csv")
+MPXV_cases_data <- read.csv(Sys.getenv("LINE_LIST", "src/data/yesterday.csv"))
 MPXV_cases_data <- subset(MPXV_cases_data, Status != "discarded")
 
 
@@ -259,4 +259,4 @@ mpxv_cases_countries <- ggplot() +
 p <- plot_grid(mpxv_map, mpxv_cases_countries,
                ncol = 1, labels = c("A", "B"), rel_heights=c(4, 3))
 
-ggsave(plot = p, "build/figures/travel-history.png", width = 6, height = 9, limitsize = FALSE)
+ggsave(plot = p, file.path(Sys.getenv("FIGURES_PATH", "build/figures"), "travel-history.png"), width = 6, height = 9, limitsize = FALSE)
@@ -0,0 +1,44 @@
+# Long-lived figure worker, started by render.py
+#
+# Loads the figure libraries once, then renders figures requested on stdin,
+# one request per line:
+#
+#   <script>\t<NAME>=<value>\t<NAME>=<value>...
+#
+# Environment variables are set before sourcing the script. Each request
+# is answered on stdout with a line starting with the reply marker,
+# followed by "ok" or "error" and the error message, tab separated.
+
+suppressPackageStartupMessages({
+  library(ggplot2)
+  library(ggpubr)
+  library(dplyr)
+  library(stringr)
+  library(RColorBrewer)
+})
+
+REPLY <- "@figure-worker"
+
+reply <- function(...) {
+  cat(paste(REPLY, ..., sep = "\t"), "\n", sep = "")
+  flush(stdout())
+}
+
+con <- file("stdin", open = "r")
+reply("ready")
+while (length(line <- readLines(con, n = 1)) > 0) {
+  fields <- strsplit(line, "\t", fixed = TRUE)[[1]]
+  for (variable in fields[-1]) {
+    name_value <- regmatches(variable, regexpr("=", variable), invert = TRUE)[[1]]
+    do.call(Sys.setenv, setNames(list(name_value[2]), name_value[1]))
+  }
+  result <- tryCatch({
+    source(fields[1], local = new.env())
+    "ok"
+  }, error = function(e) {
+    paste("error", gsub("[\t\n]", " ", conditionMessage(e)), sep = "\t")
+  })
+  # close devices left open by a failed script
+  while (dev.cur() > 1) dev.off()
+  reply(result)
+}
@@ -0,0 +1,174 @@
+"""
+Lightweight timing and memory instrumentation of build stages
+
+Stages are wrapped in span(), which records wall time, CPU time and peak
+memory of the process. Spans can be nested, and are named by joining the
+names of enclosing spans with '/'. With tracing enabled (see start()),
+peak Python memory allocated within each span is also recorded using
+tracemalloc, which slows down the build. As tracemalloc peaks are
+process-wide, they are only recorded for spans in the main thread of a
+process, which includes stages run in worker processes, but not stages run
+in worker threads.
+
+With profiling enabled, blocks wrapped in profile() are profiled with
+cProfile in whichever thread or process they run, and write_profile()
+merges them into a single profile.
+"""
+import json
+import time
+import pstats
+import cProfile
+import itertools
+import resource
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Any, Optional
+
+_spans: list[dict[str, Any]] = []
+_profiles: list[dict] = []  # cProfile stats of profiled blocks
+_lock = threading.Lock()
+_local = threading.local()
+_counter = itertools.count()
+_profiling = False
+
+
+def max_rss() -> int:
+    "Returns peak resident set size of the process in bytes"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start(trace_memory: bool = False, profile: bool = False):
+    """Clears recorded spans and profiles, and starts tracing memory
+    allocations if trace_memory, and profiling blocks if profile"""
+    global _profiling
+    with _lock:
+        _spans.clear()
+        _profiles.clear()
+    _profiling = profile
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def settings() -> dict[str, bool]:
+    "Returns arguments of start() to instrument worker processes the same way"
+    return {"trace_memory": tracemalloc.is_tracing(), "profile": _profiling}
+
+
+def _stack() -> list[dict[str, Any]]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name: str):
+    """Records wall time, CPU time and peak memory of the enclosed block
+
+    Peak traced memory is only recorded in the main thread, as tracemalloc
+    peaks are process-wide.
+    """
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    record: dict[str, Any] = {
+        "name": f"{parent['name']}/{name}" if parent else name,
+        "thread": threading.current_thread().name,
+        # monotonic clock is shared by processes, see merge()
+        "_start": (time.monotonic(), next(_counter)),
+    }
+    trace = (
+        tracemalloc.is_tracing()
+        and threading.current_thread() is threading.main_thread()
+    )
+    if trace:
+        if parent is not None and "_peak" in parent:
+            # keep parent peak before resetting it
+            parent["_peak"] = max(parent["_peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        record["_peak"] = 0
+    stack.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = round(time.perf_counter() - wall, 6)
+        record["cpu_seconds"] = round(time.process_time() - cpu, 6)
+        record["max_rss_bytes"] = max_rss()
+        stack.pop()
+        if trace:
+            peak = max(record.pop("_peak"), tracemalloc.get_traced_memory()[1])
+            record["peak_traced_bytes"] = peak
+            if parent is not None and "_peak" in parent:
+                parent["_peak"] = max(parent["_peak"], peak)
+        with _lock:
+            _spans.append(record)
+
+
+@contextmanager
+def profile():
+    "Profiles the enclosed block with cProfile if profiling is enabled"
+    if not _profiling:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.create_stats()
+        with _lock:
+            _profiles.append(profiler.stats)
+
+
+def collect() -> tuple[list[dict[str, Any]], list[dict]]:
+    "Returns recorded spans and profiles, to merge() into another process"
+    with _lock:
+        return list(_spans), list(_profiles)
+
+
+def merge(spans: list[dict[str, Any]], profiles: list[dict]):
+    "Adds spans and profiles recorded in another process, see collect()"
+    with _lock:
+        _spans.extend(spans)
+        _profiles.extend(profiles)
+
+
+class _Stats:
+    "Profile stats in the form pstats.Stats() loads"
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def write_profile(file: Path) -> bool:
+    "Writes merged profiles to file, returns whether there were any"
+    with _lock:
+        if not _profiles:
+            return False
+        stats = pstats.Stats(*[_Stats(p) for p in _profiles])
+    stats.dump_stats(file)
+    return True
+
+
+def spans() -> list[dict[str, Any]]:
+    "Returns recorded spans, in the order they started"
+    with _lock:
+        return [
+            {k: v for k, v in s.items() if not k.startswith("_")}
+            for s in sorted(_spans, key=lambda s: s["_start"])
+        ]
+
+
+def write(file: Path, extra: Optional[dict[str, Any]] = None):
+    "Writes recorded spans and peak RSS to a JSON file"
+    file.write_text(
+        json.dumps(
+            {"max_rss_bytes": max_rss(), **(extra or {}), "spans": spans()},
+            indent=2,
+        )
+    )
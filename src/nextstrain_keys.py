@@ -0,0 +1,15 @@
+"""
+S3 keys of Nextstrain metadata in the Monkeypox bucket
+
+Shared by build.py, which reads the metadata, and
+upload_nextstrain_metadata.py, which writes it, so the upload script does
+not have to import the build.
+"""
+from typing import Final
+
+NEXTSTRAIN_FILE: Final = "nextstrain_monkeypox_hmpxv1_metadata.tsv"
+# Nextstrain metadata is stored gzip compressed, or as a pointer to an
+# earlier upload with the same contents, see upload_nextstrain_metadata.py
+NEXTSTRAIN_COMPRESSED_FILE: Final = NEXTSTRAIN_FILE + ".gz"
+NEXTSTRAIN_POINTER_FILE: Final = NEXTSTRAIN_FILE + ".pointer.json"
+NEXTSTRAIN_LATEST_KEY: Final = "nextstrain_latest.json"
@@ -0,0 +1,331 @@
+"""
+Run build stages concurrently as a dependency graph
+
+Each stage declares the stages whose results it takes as arguments, and
+stages it only has to run after. Stages are started as soon as their
+dependencies finish: I/O bound stages run in a thread pool, and CPU bound
+stages with picklable arguments and results in a process pool, so the
+build takes as long as its critical path rather than the sum of stages.
+
+With a cache path, each stage is keyed by a hash of its name, the code
+version, its own external inputs and the keys of its dependencies, so a key
+changes whenever anything upstream of the stage changes. Results (and files
+written) of cached stages are stored under their key, and reused by later
+runs instead of running the stage. Cached results are only unpickled when a
+stage that runs takes them, so unchanged stages upstream of a changed one
+cost little more than restoring their files. Volatile stages, which read
+from outside the build, always run and are keyed by a hash of their result
+instead.
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import multiprocessing
+from pathlib import Path
+from typing import Any, Callable, Optional
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import pandas as pd
+
+import instrument
+
+THREAD_WORKERS = 8
+CACHE_ENTRIES = 4  # cached results kept per stage
+
+
+class Stage:
+    """Stage of a build
+
+    name: Unique name of the stage, which other stages refer to
+    func: Function called with the results of inputs, in order
+    inputs: Names of stages whose results func takes
+    after: Names of stages that have to finish first, without taking
+      their results
+    process: Run in the process pool, func and its arguments and result
+      have to be picklable
+    fingerprint: External inputs of func, such as files it reads or
+      configuration, see digest()
+    cache: Store the result and outputs under the key of the stage, and
+      reuse them in later runs, the result has to be picklable
+    outputs: Files written by func, or a function returning them from its
+      result, which are stored and restored with the result
+    volatile: Reads from outside the build, so it always runs and is keyed
+      by its result
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        inputs: list[str] = [],
+        after: list[str] = [],
+        process: bool = False,
+        fingerprint: list[Any] = [],
+        cache: bool = False,
+        outputs: list[Path] | Callable[[Any], list[Path]] = [],
+        volatile: bool = False,
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.after = after
+        self.process = process
+        self.fingerprint = fingerprint
+        self.cache = cache
+        self.outputs = outputs
+        self.volatile = volatile
+
+    @property
+    def dependencies(self) -> list[str]:
+        return self.inputs + self.after
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def digest(value: Any) -> str:
+    """Returns hash of a value
+
+    Files are hashed by their contents, dataframes by their values, and
+    other values by their JSON or pickle representation.
+    """
+    sha = hashlib.sha256()
+    if isinstance(value, Path):
+        sha.update(b"file")
+        if value.exists():
+            with value.open("rb") as fp:
+                while chunk := fp.read(1 << 20):
+                    sha.update(chunk)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        sha.update(
+            repr(value.to_frame().dtypes if value.ndim == 1 else value.dtypes).encode()
+        )
+        sha.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, (list, tuple)):
+        sha.update("".join(digest(v) for v in value).encode())
+    elif isinstance(value, dict):
+        sha.update(json.dumps({str(k): digest(v) for k, v in value.items()}).encode())
+    else:
+        try:
+            sha.update(json.dumps(value, sort_keys=True, default=str).encode())
+        except TypeError:
+            sha.update(pickle.dumps(value))
+    return sha.hexdigest()
+
+
+def _outputs(stage: Stage, result: Any) -> list[Path]:
+    return stage.outputs(result) if callable(stage.outputs) else stage.outputs
+
+
+def _cache_file(cache_path: Path, stage: Stage, key: str) -> Path:
+    return cache_path / stage.name.replace("/", "-") / f"{key}.pickle"
+
+
+def _load(cache_path: Path, stage: Stage, key: str) -> tuple[bool, bytes]:
+    "Returns whether stage is cached under key, and its pickled result"
+    if not (file := _cache_file(cache_path, stage, key)).exists():
+        return False, b""
+    try:
+        entry = pickle.loads(file.read_bytes())
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        logging.warning(f"Ignoring unreadable cache of stage {stage.name}")
+        return False, b""
+    for output, content in entry["outputs"].items():
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        Path(output).write_bytes(content)
+    os.utime(file)
+    return True, entry["result"]
+
+
+def _store(cache_path: Path, stage: Stage, key: str, result: Any):
+    file = _cache_file(cache_path, stage, key)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    entry = {
+        # pickled separately, to restore outputs without loading the result
+        "result": pickle.dumps(result),
+        "outputs": {str(f): f.read_bytes() for f in _outputs(stage, result)},
+    }
+    partial = file.with_name(f".{file.name}.part")
+    partial.write_bytes(pickle.dumps(entry))
+    os.replace(partial, file)
+    # keep the most recently used entries
+    for old in sorted(
+        file.parent.glob("*.pickle"), key=lambda f: f.stat().st_mtime, reverse=True
+    )[CACHE_ENTRIES:]:
+        old.unlink()
+
+
+def _run_span(name: str, func: Callable[..., Any], *args) -> Any:
+    with instrument.profile(), instrument.span(f"stage/{name}"):
+        return func(*args)
+
+
+def _run_process(
+    name: str, settings: dict[str, bool], func: Callable[..., Any], *args
+) -> tuple[Any, tuple[list[dict[str, Any]], list[dict]]]:
+    """Runs a stage in a worker process, instrumented as the build is
+
+    Returns the result and the spans and profiles recorded, for the build
+    process to merge.
+    """
+    instrument.start(**settings)  # workers are reused, so clear earlier records
+    result = _run_span(name, func, *args)
+    return result, instrument.collect()
+
+
+def check(stages: list[Stage]):
+    "Raise ValueError if stages have duplicate names, unknown dependencies or cycles"
+    names = [s.name for s in stages]
+    if duplicates := {n for n in names if names.count(n) > 1}:
+        raise ValueError(f"Duplicate stages: {', '.join(sorted(duplicates))}")
+    for stage in stages:
+        if unknown := set(stage.dependencies) - set(names):
+            raise ValueError(
+                f"Stage {stage.name} depends on unknown stages: {', '.join(sorted(unknown))}"
+            )
+    done: set[str] = set()
+    pending = list(stages)
+    while pending:
+        if not (ready := [s for s in pending if set(s.dependencies) <= done]):
+            raise ValueError(
+                f"Cycle between stages: {', '.join(s.name for s in pending)}"
+            )
+        done.update(s.name for s in ready)
+        pending = [s for s in pending if s.name not in done]
+
+
+def critical_path(
+    stages: list[Stage], timings: dict[str, tuple[float, float]]
+) -> list[str]:
+    """Returns names of stages on the critical path, from first to last
+
+    timings: Start and end time of each stage, as returned by run()
+    """
+    by_name = {s.name: s for s in stages}
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while deps := [d for d in by_name[path[-1]].dependencies if d in timings]:
+        path.append(max(deps, key=lambda name: timings[name][1]))
+    return path[::-1]
+
+
+def run(
+    stages: list[Stage],
+    thread_workers: int = THREAD_WORKERS,
+    process_workers: Optional[int] = None,
+    cache_path: Optional[Path] = None,
+    version: str = "",
+) -> tuple[dict[str, Any], dict[str, tuple[float, float]]]:
+    """Runs stages as soon as their dependencies finish
+
+    Returns results and (start, end) times in seconds from the start of
+    the run, by stage name. Results of cached stages which no stage that
+    ran took are not loaded, and left out. If a stage raises an exception, stages not yet
+    started are cancelled, and the exception is raised once running stages
+    finish.
+
+    cache_path: Folder to cache results of stages with cache set in
+    version: Version of the code run by stages, part of every key
+    """
+    check(stages)
+    results: dict[str, Any] = {}
+    cached: dict[str, bytes] = {}  # pickled results, loaded when taken
+    timings: dict[str, tuple[float, float]] = {}
+    keys: dict[str, str] = {}
+
+    def key(stage: Stage) -> str:
+        return digest(
+            [stage.name, version, stage.fingerprint]
+            + [keys[name] for name in stage.dependencies]
+        )
+
+    def value(name: str) -> Any:
+        if name in cached:
+            results[name] = pickle.loads(cached.pop(name))
+        return results[name]
+
+    started = time.perf_counter()
+    pending = list(stages)
+    running: dict[Future, Stage] = {}
+    threads = ThreadPoolExecutor(thread_workers)
+    # workers are not forked from this process, as the stages already running
+    # in threads could be holding locks which the children would inherit
+    processes = (
+        ProcessPoolExecutor(
+            process_workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+        if any(s.process for s in stages)
+        else None
+    )
+    try:
+        while pending or running:
+            # cached stages finish immediately, which can make others ready
+            while ready := [
+                s for s in pending if set(s.dependencies) <= set(results) | set(cached)
+            ]:
+                for stage in ready:
+                    pending.remove(stage)
+                    if cache_path and not stage.volatile:
+                        keys[stage.name] = key(stage)
+                        if stage.cache:
+                            hit, pickled = _load(cache_path, stage, keys[stage.name])
+                            if hit:
+                                logging.info(f"Using cached stage {stage.name}")
+                                cached[stage.name] = pickled
+                                timings[stage.name] = (
+                                    time.perf_counter() - started,
+                                ) * 2
+                                continue
+                    args = [value(name) for name in stage.inputs]
+                    logging.info(f"Starting stage {stage.name}")
+                    if stage.process:
+                        future = processes.submit(
+                            _run_process,
+                            stage.name,
+                            instrument.settings(),
+                            stage.func,
+                            *args,
+                        )
+                    else:
+                        future = threads.submit(
+                            _run_span, stage.name, stage.func, *args
+                        )
+                    running[future] = stage
+                    timings[stage.name] = (time.perf_counter() - started, 0)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                timings[stage.name] = (
+                    timings[stage.name][0],
+                    time.perf_counter() - started,
+                )
+                result = future.result()  # raises stage exception
+                if stage.process:
+                    result, records = result
+                    instrument.merge(*records)
+                results[stage.name] = result
+                if cache_path and stage.volatile:
+                    keys[stage.name] = digest(
+                        [stage.name, version, results[stage.name]]
+                    )
+                elif cache_path and stage.cache:
+                    _store(cache_path, stage, keys[stage.name], results[stage.name])
+                logging.info(
+                    f"Finished stage {stage.name} in "
+                    f"{timings[stage.name][1] - timings[stage.name][0]:.1f}s"
+                )
+    finally:
+        threads.shutdown(cancel_futures=True)
+        if processes:
+            processes.shutdown(cancel_futures=True)
+    return results, timings
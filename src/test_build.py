@@ -1,14 +1,30 @@
 import io
+import os
+import sys
 import json
+import pstats
+import tracemalloc
 import random
 import datetime
 import urllib.parse
+from typing import Any
+from pathlib import Path
 
 import pandas as pd
 import pytest
 import requests
 
 import build
+import cache
+import instrument
+import stages
+import archives
+import aggregates
+import benchmark
+import upload_nextstrain_metadata
+import choropleth
+import country_names
+import figures.render as render
 
 HEX = list(map(str, range(10))) + ["a", "b", "c", "d", "e", "f"]
 SHA = "9c9dce36ed84fd2c3fde112249fe17450f885ab4"
@@ -297,24 +313,17 @@ def test_counts():
 
 @pytest.mark.parametrize(
     "source,expected",
-    [(40, 40), ("40", 40), ("20-30", 25), ("20-40", 30), ("0-5", 2.5)],
+    [(40, 40), ("40", 40), ("20-30", 25), ("20-40", 30), ("0-5", 2.5), ("20.5", 20.5)],
 )
-def test_mid_bucket_age(source, expected):
-    assert build.mid_bucket_age(source) == expected
+def test_parse_ages_mid(source, expected):
+    assert build.parse_ages(pd.Series([source])).Age_mid[0] == expected
 
 
 @pytest.mark.parametrize(
     "source,expected", [(5, 0), (80, 7), (90, 8), (100, 8), (0, 0), (39, 3), (41, 4)]
 )
-def test_age_bucket(source, expected):
-    assert build.age_bucket(source) == expected
-
-
-def test_age_bucket_failure():
-    with pytest.raises(ValueError):
-        build.age_bucket(-1)
-    with pytest.raises(ValueError):
-        build.age_bucket(121)
+def test_age_buckets(source, expected):
+    assert build.age_buckets(pd.Series([source]))[0] == expected
 
 
 @pytest.mark.parametrize(
@@ -327,13 +336,40 @@ def test_age_bucket_failure():
         ("81 - 100", False),
     ],
 )
-def test_not_same_age_bucket(source, expected):
-    assert build.not_same_age_bucket(source) == expected
+def test_parse_ages_multiple_buckets(source, expected):
+    ages = build.parse_ages(pd.Series([source]))
+    assert (ages.Age_start_bucket[0] != ages.Age_end_bucket[0]) == expected
 
 
-def test_not_same_age_bucket_failure():
-    with pytest.raises(ValueError, match=r"Invalid age.*"):
-        build.not_same_age_bucket("85-121")
+def test_parse_ages_invalid(caplog):
+    ages = build.parse_ages(
+        pd.Series(["85-121", "<40", "<40", "", None, "40-30", "unknown", "35"])
+    )
+    assert ages.Age_mid.isna().tolist() == [True] * 7 + [False]
+    assert ages.Age_start_bucket.isna().sum() == 7
+    assert caplog.text.count("invalid ages") == 1
+    assert "Ignoring 5 invalid ages: <40 (2)" in caplog.text
+
+
+def test_age_gender():
+    df = pd.DataFrame(
+        {
+            "ID": ["N1", "N2", "N3", "N4", "N5"],
+            "Status": ["confirmed", "confirmed", "confirmed", "suspected", "confirmed"],
+            "Country": ["Spain"] * 5,
+            "Age": ["25", "20-40", "<40", "25", "85"],
+            "Gender": ["male", "female", "male", "male", "female"],
+        }
+    )
+    totals = build.age_gender(df).set_index(["Age", "Gender"]).total
+    assert len(totals) == 18 and totals.sum() == 3
+    assert totals["21-30", "male"] == 1
+    assert totals["11-20", "female"] == totals["21-30", "female"] == 1 / 3
+    assert totals["80+", "female"] == 1
+    variants = df.assign(Gender=["Male", " female", "male ", "male", "FEMALE"])
+    assert build.age_gender(variants.astype({"Gender": "category"})).equals(
+        build.age_gender(df)
+    )
 
 
 def test_demographics():
@@ -343,3 +379,946 @@ def test_demographics():
         "pc_valid_age_gender_in_confirmed": 80,
         "percentage_male": 80,
     }
+
+
+def test_case_summary():
+    summary = build.CaseSummary(TODAY)
+    assert "omit_error" not in set(summary.df.Status)
+    assert summary.status_country.loc["confirmed"].to_dict() == {
+        "Belgium": 0,
+        "England": 2,
+        "USA": 3,
+    }
+    assert len(summary.confirmed) == 5
+    assert build.summarise(summary) is summary
+    assert build.n_cases(summary, "suspected") == build.n_cases(TODAY, "suspected")
+
+
+def test_case_summary_missing_values():
+    df = pd.DataFrame(
+        {
+            "Status": ["confirmed", "confirmed", None, "suspected", "discarded"],
+            "Country": ["Peru", None, "Chile", "Spain", "Spain"],
+        }
+    ).astype("category")
+    summary = build.CaseSummary(df)
+    assert build.n_countries(summary, "confirmed") == 2  # missing country counted
+    # Chile has a case with missing status, Spain a discarded case
+    assert build.n_countries(summary, "suspected", only=True) == 0
+    assert build.confirmed_by_country(summary).to_dict() == {"Peru": 1}
+
+
+def test_table_confirmed_cases():
+    html = build.table_confirmed_cases(TODAY, YESTERDAY)["embed_table_confirmed_cases"]
+    # England has no confirmed cases in YESTERDAY, so only USA is compared
+    assert "<td>USA</td>\n      <td>3</td>\n      <td>50</td>" in html
+    assert "England" not in html
+
+
+def test_ingest(tmp_path):
+    csv_file = tmp_path / "yesterday.csv"
+    csv_file.write_text(
+        """ID,Status,Country,Gender,Date_confirmation
+N1,confirmed,USA,male,2022-06-01
+N2,suspected,England,,
+"""
+    )
+    df = pd.read_parquet(build.ingest(csv_file))
+    assert df.Status.dtype == "category"
+    assert df.Country.dtype == "category"
+    assert pd.api.types.is_datetime64_any_dtype(df.Date_confirmation)
+    assert build.n_cases(df, "confirmed") == 1
+    assert build.ingest_snapshot(csv_file, fetched=False) is None  # up to date
+    parquet_file = csv_file.with_suffix(".parquet")
+    os.utime(parquet_file, (csv_file.stat().st_mtime - 1,) * 2)
+    assert build.needs_ingest(csv_file)
+    assert build.ingest_snapshot(csv_file, fetched=False) == parquet_file
+    assert not build.needs_ingest(csv_file)
+
+
+def test_read_columns(tmp_path):
+    csv_file = tmp_path / "last_week.csv"
+    csv_file.write_text(
+        """ID,Status,Country,Age
+N1,confirmed,USA,20-29
+"""
+    )
+    parquet_file = build.ingest(csv_file)
+    df = build.read_columns(
+        parquet_file, build.SNAPSHOT_COLUMNS["day_before_yesterday"]
+    )
+    assert list(df.columns) == ["ID", "Status", "Country"]
+    df = build.read_columns(parquet_file, build.SNAPSHOT_COLUMNS["yesterday"])
+    assert list(df.columns) == ["ID", "Status", "Country", "Age"]  # present only
+    assert len(build.read_columns(parquet_file, None).columns) == 4
+
+
+def test_load_snapshot(tmp_path, monkeypatch):
+    csv_file = tmp_path / "snapshot.csv"
+    csv_file.write_text("ID,Status,Country,Age,Notes\nN1,confirmed,USA,20-29,x\n")
+    parquet_file = build.ingest(csv_file)
+    reads = []
+    read_columns = build.read_columns
+    monkeypatch.setattr(
+        build, "read_columns", lambda *args: reads.append(args) or read_columns(*args)
+    )
+    build._load_snapshot.cache_clear()
+    yesterday = build.load_snapshot(parquet_file, "yesterday")
+    prev_df = build.load_snapshot(parquet_file, "day_before_yesterday")
+    assert list(yesterday.columns) == ["ID", "Status", "Country", "Age"]
+    assert list(prev_df.columns) == ["ID", "Status", "Country"]
+    assert len(reads) == 1  # loaded once for both roles
+    build._load_snapshot.cache_clear()
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+
+class FakeSession:
+    def __init__(self, responses: dict[str, FakeResponse]):
+        self.responses = responses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get(self, url, **kwargs):
+        return self.responses[url]
+
+
+def test_fetch_urls(monkeypatch, tmp_path):
+    monkeypatch.setattr(build, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(
+        build,
+        "http_session",
+        lambda: FakeSession(
+            {
+                "http://a": FakeResponse(200, b"a,b\n1,2\n"),
+                "http://b": FakeResponse(404, b""),
+            }
+        ),
+    )
+    with pytest.raises(ConnectionError, match="http://b"):
+        build.fetch_urls(["http://a", "http://b"], ["a.csv", "b.csv"], use_cache=False)
+    assert (tmp_path / "a.csv").read_bytes() == b"a,b\n1,2\n"
+    assert not (tmp_path / "b.csv").exists()
+    assert list(tmp_path.glob(".*.part")) == []
+
+
+def test_fetch_urls_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(build, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(cache, "CACHE_PATH", tmp_path / "cache")
+    monkeypatch.setattr(
+        build,
+        "http_session",
+        lambda: FakeSession({"http://a": FakeResponse(200, b"a,b\n1,2\n")}),
+    )
+    build.fetch_urls(["http://a"], ["a.csv"])
+    assert cache.get("http://a").read_bytes() == b"a,b\n1,2\n"
+
+    # served from cache without touching the network
+    monkeypatch.setattr(build, "http_session", lambda: FakeSession({}))
+    build.fetch_urls(["http://a"], ["b.csv"])
+    assert (tmp_path / "b.csv").read_bytes() == b"a,b\n1,2\n"
+
+
+def test_cache_evict(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_PATH", tmp_path)
+    for i, url in enumerate(["http://a", "http://b", "http://c"]):
+        (file := cache.path(url)).parent.mkdir(exist_ok=True)
+        file.write_bytes(b"x" * 10)
+        os.utime(file, (i, i))
+    cache.evict(max_bytes=20)
+    assert cache.get("http://a") is None
+    assert cache.get("http://b") and cache.get("http://c")
+    cache.path("http://b").with_suffix(".parquet").write_bytes(b"x" * 10)
+    cache.evict(max_bytes=0, keep=["http://b"])
+    assert cache.get("http://b") and cache.get("http://c") is None
+    assert cache.path("http://b").with_suffix(".parquet").exists()
+
+
+def test_input_files_overrides():
+    links = [
+        data["download_url"]
+        for data in GITHUB_ARCHIVE_API
+        if data["download_url"].endswith("csv")
+    ]
+    files = build.input_files(
+        links, date(2022, 6, 20), {"file": "http://foo.bar/override.csv"}
+    )
+    assert files["file"] == "http://foo.bar/override.csv"
+    assert files["previous_day_file"].endswith("2022-06-16%2018%3A00%3A00.csv")
+
+
+def test_working_days():
+    assert build.working_days(date(2022, 6, 17), date(2022, 6, 21)) == [
+        date(2022, 6, 17),
+        date(2022, 6, 20),
+        date(2022, 6, 21),
+    ]
+
+
+@pytest.mark.parametrize(
+    "items,n,expected",
+    [
+        ([1, 2, 3, 4, 5], 2, [[1, 2, 3], [4, 5]]),
+        ([1, 2], 4, [[1], [2]]),
+        ([], 3, []),
+    ],
+)
+def test_chunks(items, n, expected):
+    assert build.chunks(items, n) == expected
+
+
+def test_changes():
+    change_set = build.changes(TODAY, YESTERDAY)
+    assert list(change_set.ID) == ["N4", "N5", "N6", "N7", "N8", "N9"]
+    assert change_set.Status_prev.isna().all()
+    assert build.status_transitions(change_set) == {
+        "none_to_confirmed": 3,
+        "none_to_discarded": 1,
+        "none_to_suspected": 2,
+    }
+
+
+def test_status_transitions():
+    change_set = build.changes(
+        dataframe("ID,Status,Country\nN1,confirmed,USA\nN2,confirmed,USA\n"),
+        dataframe("ID,Status,Country\nN1,suspected,USA\nN3,suspected,USA\n"),
+    )
+    assert build.status_transitions(change_set) == {
+        "none_to_confirmed": 1,
+        "suspected_to_confirmed": 1,
+        "suspected_to_none": 1,
+    }
+
+
+def test_changes_missing_country():
+    columns = "ID,Status,Country,Travel_history (Y/N/NA),Travel_history_location\n"
+    df = dataframe(columns + "N1,confirmed,,,\nN2,confirmed,USA,,\n")
+    prev_df = dataframe(columns + "N1,confirmed,,,\nN2,suspected,USA,,\n")
+    assert list(build.changes(df, prev_df).ID) == ["N2"]
+    var = build.counts(df, prev_df)
+    assert var["diff_countries"] == []
+    assert var["text_diff_countries"] == ""
+
+
+def test_changes_duplicate_ids():
+    columns = "ID,Status,Country,Travel_history (Y/N/NA),Travel_history_location\n"
+    df = dataframe(
+        columns
+        + "N1,confirmed,USA,,\nN1,confirmed,USA,,\nN2,confirmed,USA,,\n"
+        + "N3,confirmed,Peru,,\n"
+    )
+    prev_df = dataframe(columns + "N1,suspected,USA,,\nN1,suspected,USA,,\n")
+    assert build.status_transitions(build.changes(df, prev_df)) == {
+        "none_to_confirmed": 2,
+        "suspected_to_confirmed": 1,
+    }
+    var = build.counts(df, prev_df)
+    assert var["n_diff_confirmed"] == 4  # compared by aggregates
+    assert var["diff_countries"] == ["Peru"]
+
+
+@pytest.fixture
+def figure_root(monkeypatch, tmp_path):
+    (tmp_path / "src" / "figures").mkdir(parents=True)
+    (tmp_path / "src" / "data").mkdir()
+    (tmp_path / "src" / "figures" / "genomics.r").write_text("# genomics")
+    (tmp_path / "src" / "data" / "genomics.csv").write_text("a,b\n1,2\n")
+    monkeypatch.setattr(render, "ROOT", tmp_path)
+    monkeypatch.setattr(
+        render, "FINGERPRINTS_FILE", tmp_path / "src" / "data" / "figures.json"
+    )
+    monkeypatch.setattr(
+        render,
+        "DEFAULT_ENV",
+        {"GENOMICS_DATA": tmp_path / "src" / "data" / "genomics.csv"},
+    )
+    rendered = []
+
+    def render_script(self, script, env, timeout):
+        rendered.append(script.name)
+        (Path(env["FIGURES_PATH"]) / "genomics.png").write_bytes(b"")
+
+    monkeypatch.setattr(render.RWorker, "render", render_script)
+    return tmp_path, rendered
+
+
+def test_render_figures_skips_current(figure_root):
+    root, rendered = figure_root
+    figures_path = root / "build" / "figures"
+    with render.RWorkerPool() as pool:
+        render.render_figures(["genomics"], pool, figures_path=figures_path)
+        render.render_figures(["genomics"], pool, figures_path=figures_path)
+        assert rendered == ["genomics.r"]
+        (root / "src" / "data" / "genomics.csv").write_text("a,b\n1,3\n")
+        render.render_figures(["genomics"], pool, figures_path=figures_path)
+        assert len(rendered) == 2
+
+
+def test_render_figures_failure(figure_root, monkeypatch):
+    def fail(self, script, env, timeout):
+        raise RuntimeError("error")
+
+    monkeypatch.setattr(render.RWorker, "render", fail)
+    with pytest.raises(RuntimeError, match="Failed to generate figures: .*genomics"):
+        render.render_figures(["genomics"], figures_path=figure_root[0] / "build")
+
+
+FAKE_R_WORKER = """
+import sys
+print("@figure-worker\\tready", flush=True)
+for line in sys.stdin:
+    script, *env = line.rstrip("\\n").split("\\t")
+    print("some output from the script")
+    if script.endswith("fail.r"):
+        print("@figure-worker\\terror\\tobject 'x' not found", flush=True)
+    else:
+        print("@figure-worker\\tok", flush=True)
+"""
+
+
+def test_r_worker(monkeypatch, tmp_path):
+    (worker_script := tmp_path / "worker.py").write_text(FAKE_R_WORKER)
+    monkeypatch.setattr(render, "ROOT", tmp_path)
+    monkeypatch.setattr(render.RWorker, "command", [sys.executable, str(worker_script)])
+    worker = render.RWorker()
+    worker.render(tmp_path / "ok.r", {"LINE_LIST": "a.csv"}, timeout=10)
+    process = worker.process
+    with pytest.raises(RuntimeError, match="object 'x' not found"):
+        worker.render(tmp_path / "fail.r", {}, timeout=10)
+    worker.render(tmp_path / "ok.r", {}, timeout=10)
+    assert worker.process is process  # same session for all figures
+    worker.close()
+
+
+TRAVEL_HISTORY = dataframe(
+    """ID,Status,Country_ISO3,Travel_history_country,Travel_history_entry
+N1,confirmed,USA,Spain,2022-05-01
+N2,confirmed,USA,Spain,
+N3,confirmed,GBR,Spain; Germany,2022-05-03
+N4,confirmed,ESP,Spain,2022-05-04
+N5,suspected,USA,Spain,2022-05-05
+N6,confirmed,DEU,Gran Canaria,2022-05-06
+N7,confirmed,DEU,,
+"""
+)
+
+
+@pytest.fixture
+def country_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(country_names, "NAMES_FILE", tmp_path / "country_names.json")
+    monkeypatch.setattr(country_names, "_index", None)
+    monkeypatch.setattr(country_names, "_reported_misses", set())
+
+
+def test_to_iso3(country_index, caplog):
+    names = pd.Series(["England", " usa", "Narnia", None, "Narnia", "Germany"])
+    assert country_names.to_iso3(names).tolist() == [
+        "GBR",
+        "USA",
+        None,
+        None,
+        None,
+        "DEU",
+    ]
+    assert caplog.text.count("Narnia") == 1
+    country_names.to_iso3(names)
+    assert caplog.text.count("Narnia") == 1  # misses reported once
+    assert json.loads(country_names.NAMES_FILE.read_text())["names"]["england"] == "GBR"
+
+
+def test_to_iso3_concurrent(country_index):
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = [pd.Series([name]) for name in country_names.NAMES.values()][:40]
+    with ThreadPoolExecutor(8) as pool:
+        iso3 = list(pool.map(country_names.to_iso3, names))
+    assert all(code[0] is not None for code in iso3)
+    stored = json.loads(country_names.NAMES_FILE.read_text())["names"]
+    assert len(stored) == len(names)
+    assert not list(country_names.NAMES_FILE.parent.glob("*.part"))
+
+
+def test_standardise(country_index):
+    assert country_names.standardise(
+        pd.Series(["Scotland", "USA", "Narnia"])
+    ).tolist() == ["United Kingdom", "United States", "Narnia"]
+
+
+def test_choropleth_travel_history(country_index):
+    th = choropleth.travel_history(TRAVEL_HISTORY)
+    assert {
+        route: (row.len, row.list, row.Travel_route)
+        for route, row in zip(th.index, th.itertuples())
+    } == {
+        ("ESP", "USA"): (2, ["2022-05-01"], ["Spain", "United States"]),
+        ("ESP", "DEU", "GBR"): (
+            1,
+            ["2022-05-03"],
+            ["Spain", "Germany", "United Kingdom"],
+        ),
+        ("ESP", "DEU"): (1, ["2022-05-06"], ["Spain", "Germany"]),
+    }
+
+
+def test_travel_route_traces(country_index):
+    th = choropleth.travel_history(TRAVEL_HISTORY)
+    (trace,) = choropleth.travel_route_traces(th)
+    assert trace.lon.count(None) == 3  # one gap after each route
+    assert len(trace.lon) == len(trace.lat) == len(trace.text) == 10
+    assert trace.text[0] == "Spain ➔ United States<br>2022-05-01"
+    assert len(choropleth.travel_route_traces(th, max_routes=1)[0].lon) == 3
+
+
+def test_render_figure_assets(tmp_path):
+    import gzip
+    import plotly.graph_objects as go
+
+    fig = go.Figure(go.Bar(x=["a", "b"], y=[1, 2]))
+    (html,) = build.render_figure(fig, "embed", tmp_path).values()
+    (asset,) = tmp_path.glob("*.json")
+    assert html == f'<div class="plotly-figure" data-src="/assets/{asset.name}"></div>'
+    assert json.loads(gzip.decompress(asset.read_bytes()))["data"][0]["type"] == "bar"
+    assert build.render_figure(fig, "embed", tmp_path) == {"embed": html}
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+class FakeS3:
+    "Stands in for the S3 resource, serving index.json files from a dict"
+
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self, objects: dict[str, dict]):
+        self.objects = objects
+        self.listed = []
+        self.meta = self
+        self.client = self
+        self.exceptions = self
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        self.listed.append((Prefix, Delimiter))
+        folders = sorted({k.split("/")[0] + "/" for k in self.objects})
+        return [{"CommonPrefixes": [{"Prefix": f} for f in folders]}]
+
+    def Object(self, bucket, key):
+        return FakeS3Object(self, key)
+
+    def get_object(self, Bucket, Key):
+        return FakeS3Object(self, Key).get()
+
+
+class FakeS3Object:
+    def __init__(self, s3: FakeS3, key: str):
+        self.s3, self.key = s3, key
+
+    def get(self):
+        if self.key not in self.s3.objects:
+            raise self.s3.NoSuchKey(self.key)
+        return {"Body": io.BytesIO(json.dumps(self.s3.objects[self.key]).encode())}
+
+    def put(self, Body, ContentType):
+        self.s3.objects[self.key] = json.loads(Body)
+
+
+def report_index(day: int) -> dict[str, Any]:
+    return {
+        "date": f"2022-07-{day:02d}",
+        "n_confirmed": day,
+        "n_suspected": 0,
+        "n_countries": 1,
+    }
+
+
+def test_fetch_list(monkeypatch):
+    fake = FakeS3(
+        {f"2022-07-{d:02d}/index.json": report_index(d) for d in range(1, 30)}
+    )
+    fake.objects["2022-06-30/figures/age-gender.png"] = {}
+    monkeypatch.setattr(archives, "s3", fake)
+    archives_list = archives.fetch_list("bucket", workers=4)["archives"]
+    assert fake.listed == [("20", "/")]
+    assert [a["n_confirmed"] for a in archives_list] == list(range(29, 0, -1))
+    assert archives_list[0] == {
+        "date": "2022-07-29",
+        "n_confirmed": 29,
+        "n_suspected": 0,
+    }
+
+
+def test_update_manifest(monkeypatch):
+    fake = FakeS3({f"2022-07-{d:02d}/index.json": report_index(d) for d in range(1, 4)})
+    monkeypatch.setattr(archives, "s3", fake)
+    archives.update_manifest("bucket", "2022-07-03")  # no manifest, rebuilt
+    assert len(fake.listed) == 1
+    assert len(fake.objects[archives.MANIFEST_KEY]["archives"]) == 3
+
+    fake.objects["2022-07-04/index.json"] = report_index(4)
+    fake.objects["2022-07-03/index.json"]["n_confirmed"] = 30
+    archives.update_manifest("bucket", "2022-07-04")
+    archives_list = archives.update_manifest("bucket", "2022-07-03")["archives"]
+    assert len(fake.listed) == 1  # appended without listing
+    assert [a["date"] for a in archives_list] == [
+        "2022-07-04",
+        "2022-07-03",
+        "2022-07-02",
+        "2022-07-01",
+    ]
+    assert archives_list[1]["n_confirmed"] == 30
+    assert fake.objects[archives.MANIFEST_KEY] == {"archives": archives_list}
+
+
+class FakeS3Client:
+    "Stands in for the S3 client, storing objects in a dict"
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[Key] = Body.encode() if isinstance(Body, str) else Body
+
+    def upload_fileobj(self, fileobj, Bucket, Key, ExtraArgs):
+        self.objects[Key] = fileobj.read()
+
+    def download_file(self, Bucket, Key, Filename):
+        import botocore.exceptions
+
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404"}}, "HeadObject"
+            )
+        Path(Filename).write_bytes(self.objects[Key])
+
+
+def test_nextstrain_upload(monkeypatch, tmp_path):
+    import gzip
+    import boto3
+
+    s3 = FakeS3Client()
+    monkeypatch.setattr(boto3, "client", lambda service: s3)
+    monkeypatch.setenv("MONKEYPOX_BUCKET", "bucket")
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text("strain\tdate\n" + "MPXV/1\t2022-07-01\n" * 100000)
+
+    upload_nextstrain_metadata.upload(metadata)
+    today = datetime.date.today()
+    compressed = s3.objects[f"{today}/{build.NEXTSTRAIN_COMPRESSED_FILE}"]
+    assert gzip.decompress(compressed) == metadata.read_bytes()
+    del s3.objects[f"{today}/{build.NEXTSTRAIN_COMPRESSED_FILE}"]
+    s3.objects[f"2022-07-01/{build.NEXTSTRAIN_COMPRESSED_FILE}"] = compressed
+    s3.objects[upload_nextstrain_metadata.NEXTSTRAIN_LATEST_KEY] = json.dumps(
+        {
+            "key": f"2022-07-01/{build.NEXTSTRAIN_COMPRESSED_FILE}",
+            "sha256": upload_nextstrain_metadata.checksum(metadata),
+        }
+    ).encode()
+
+    upload_nextstrain_metadata.upload(metadata)  # unchanged
+    assert f"{today}/{build.NEXTSTRAIN_COMPRESSED_FILE}" not in s3.objects
+    assert f"{today}/{build.NEXTSTRAIN_POINTER_FILE}" in s3.objects
+    s3.objects[f"2022-06-01/{build.NEXTSTRAIN_FILE}"] = b"legacy"
+
+    for date, contents in [
+        ("2022-07-01", metadata.read_bytes()),
+        (today, metadata.read_bytes()),
+        ("2022-06-01", b"legacy"),
+    ]:
+        build.fetch_nextstrain("bucket", date, tmp_path / "fetched.tsv")
+        assert (tmp_path / "fetched.tsv").read_bytes() == contents
+
+
+def test_read_nextstrain(monkeypatch, tmp_path, country_index):
+    from figures import genomics
+
+    monkeypatch.setattr(build, "NEXTSTRAIN_CHUNK_SIZE", 2)
+    metadata = tmp_path / "metadata.tsv"
+    pd.DataFrame(
+        {
+            "strain": ["a", "b", "c", "d", "e"],
+            "country": ["USA", "Spain", "Spain", "Nigeria", "Spain"],
+            "date": [
+                "2022-06-01",
+                "2022-06-02",
+                "2017-01-01",
+                "2022-06-03",
+                "2022-07-01",
+            ],
+            "clade_membership": ["B.1", "B.1", "B.1", "A.1", "A.2"],
+            "host": ["Homo sapiens"] * 5,
+            "author": ["x"] * 5,
+        }
+    ).to_csv(metadata, sep="\t", index=False)
+    df = build.read_nextstrain(metadata)
+    assert list(df.columns) == build.NEXTSTRAIN_COLUMNS
+    assert df.country.tolist() == ["USA", "Spain", "Spain"]
+    assert build.counts_nextstrain(df) == {
+        "n_genomes": 3,
+        "country_with_most_genomes": "Spain",
+    }
+    assert metadata.with_suffix(".parquet").exists()
+    pd.testing.assert_frame_equal(build.read_nextstrain(metadata), df)
+    agg = genomics.aggregate(
+        pd.DataFrame({"ID": ["N1"], "Status": ["confirmed"], "Country": ["Spain"]}),
+        df,
+    )
+    assert agg.set_index("Country").nextstrain_genome_count.to_dict() == {
+        "Spain": 2,
+        "United States": 1,
+    }
+
+
+def test_generate_line_list():
+    df = benchmark.generate_line_list(1000, seed=1)
+    pd.testing.assert_frame_equal(df, benchmark.generate_line_list(1000, seed=1))
+    assert len(df) == 1000 and df.ID.is_unique
+    assert {"Status", "Country", "Gender"} <= set(df.select_dtypes("category").columns)
+    assert df.Travel_history_country.notna().sum() > 0
+    prev_df = benchmark.previous_line_list(df)
+    assert len(prev_df) < len(df)
+    assert build.counts(df, prev_df)["n_diff_confirmed"] > 0
+
+
+def test_benchmark_regressions():
+    results = benchmark.run(200, repeat=1, only=["build.counts", "choropleth.counts"])
+    assert set(results["results"]) == {"build.counts", "choropleth.counts"}
+    assert results["results"]["build.counts"]["peak_bytes"] > 0
+    slower = json.loads(json.dumps(results))
+    slower["results"]["build.counts"]["seconds"] += 1
+    assert benchmark.regressions(results, results) == []
+    assert benchmark.regressions(results, slower) == [
+        f"build.counts: {results['results']['build.counts']['seconds']:.3f}s -> "
+        f"{slower['results']['build.counts']['seconds']:.3f}s"
+    ]
+    with pytest.raises(ValueError, match="rows"):
+        benchmark.regressions(results, {**results, "rows": 100})
+
+
+def test_instrument_spans(tmp_path):
+    import tracemalloc
+
+    instrument.start(trace_memory=True)
+    try:
+        with instrument.span("metrics"):
+            with instrument.span("counts"):
+                data = [0] * 1_000_000
+            del data
+            with instrument.span("demographics"):
+                pass
+    finally:
+        tracemalloc.stop()
+    instrument.write(tmp_path / "metrics.json", {"date": "2022-07-01"})
+    metrics = json.loads((tmp_path / "metrics.json").read_text())
+    assert metrics["date"] == "2022-07-01"
+    spans = {s["name"]: s for s in metrics["spans"]}
+    assert list(spans) == ["metrics", "metrics/counts", "metrics/demographics"]
+    assert spans["metrics/counts"]["peak_traced_bytes"] >= 8_000_000
+    assert spans["metrics/demographics"]["peak_traced_bytes"] < 1_000_000
+    assert spans["metrics"]["peak_traced_bytes"] >= 8_000_000
+    assert spans["metrics"]["wall_seconds"] >= spans["metrics/counts"]["wall_seconds"]
+    assert all(s["cpu_seconds"] >= 0 and s["max_rss_bytes"] > 0 for s in spans.values())
+    instrument.start()
+    assert instrument.spans() == []
+
+
+@pytest.fixture
+def aggregate_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(aggregates, "AGGREGATES_FILE", tmp_path / "aggregates.sqlite")
+
+
+def test_stored_summary(aggregate_store):
+    df = benchmark.generate_line_list(2000)
+    last_week_df = benchmark.previous_line_list(df, 7)
+    reads = []
+
+    def read():
+        reads.append(1)
+        return last_week_df
+
+    date = datetime.date(2022, 7, 25)
+    stored = build.stored_summary("archives/2022-07-25.csv", date, read)
+    stored = build.stored_summary("archives/2022-07-25.csv", date, read)
+    assert len(reads) == 1
+    assert build.table_confirmed_cases(df, stored) == build.table_confirmed_cases(
+        df, last_week_df
+    )
+    counts = aggregates.load("archives/2022-07-25.csv")
+    assert list(counts.columns) == aggregates.COLUMNS
+    assert counts.n.sum() == len(build.initial_filter(last_week_df))
+    assert set(counts.Gender) == {"", "male", "female", "other"}
+    assert counts.Age_bucket.min() == -1 and counts.Age_bucket.max() <= 8
+
+
+def test_aggregates_history(aggregate_store):
+    counts = pd.DataFrame(
+        {
+            "Country": ["Spain", "Spain", "Peru"],
+            "Status": ["confirmed", "confirmed", "suspected"],
+            "Gender": ["male", "", ""],
+            "Age_bucket": [2, -1, -1],
+            "n": [3, 1, 5],
+        }
+    )
+    aggregates.save("2022-07-01.1.csv", datetime.date(2022, 7, 1), counts)
+    aggregates.save("2022-07-01.2.csv", datetime.date(2022, 7, 1), counts.assign(n=2))
+    aggregates.save("2022-07-02.1.csv", datetime.date(2022, 7, 2), counts)
+    aggregates.save("2022-07-02.1.csv", datetime.date(2022, 7, 2), counts.assign(n=5))
+    assert aggregates.load("missing.csv") is None
+    assert aggregates.history()["Spain"].tolist() == [4, 10]
+    assert aggregates.history("suspected")["Peru"].tolist() == [2, 5]
+
+
+def test_store_counts(aggregate_store, tmp_path):
+    csv_file = tmp_path / "snapshot.csv"
+    benchmark.generate_line_list(500).to_csv(csv_file, index=False)
+    snapshot = build.ingest(csv_file)
+    build.store_counts(
+        [(datetime.date(2022, 7, 4), "https://x/2022-07-01.csv", snapshot)]
+    )
+    history = aggregates.history()
+    assert list(history.index) == [pd.Timestamp("2022-07-01")]
+    assert history.sum(axis=1).iloc[0] == build.n_cases(
+        pd.read_csv(csv_file), "confirmed"
+    )
+
+
+def test_backfill(monkeypatch, tmp_path, aggregate_store, country_index):
+    monkeypatch.setattr(build, "DATA_PATH", tmp_path / "data")
+    monkeypatch.setattr(build, "BUILD_PATH", tmp_path / "build")
+    monkeypatch.setattr(cache, "CACHE_PATH", tmp_path / "cache")
+    (tmp_path / "build").mkdir()
+    (tmp_path / "overrides.yml").touch()
+    days = [datetime.date(2022, 7, day) for day in range(6, 15)]
+    links = [f"https://x/archives/{day}.csv" for day in days]
+    monkeypatch.setattr(build, "get_archives_list", lambda suffix: links)
+    df = benchmark.generate_line_list(500)
+    for n, url in enumerate(reversed(links)):
+        (file := cache.path(url)).parent.mkdir(parents=True, exist_ok=True)
+        benchmark.previous_line_list(df, n + 1).to_csv(file, index=False)
+    (nextstrain_path := tmp_path / "data" / "nextstrain").mkdir(parents=True)
+    for date in ["2022-07-13", "2022-07-14", "2022-07-15"]:
+        pd.DataFrame(
+            {
+                "country": ["USA", "Spain"],
+                "date": ["2022-06-01", "2022-06-02"],
+                "clade_membership": ["B.1", "B.1"],
+                "host": ["Homo sapiens"] * 2,
+            }
+        ).to_csv(nextstrain_path / f"{date}.tsv", sep="\t", index=False)
+
+    build.backfill(
+        "bucket",
+        datetime.date(2022, 7, 13),
+        datetime.date(2022, 7, 15),
+        skip_fetch=True,
+        skip_figures=True,
+        overrides_file=str(tmp_path / "overrides.yml"),
+        workers=2,
+    )
+    for date in ["2022-07-13", "2022-07-14", "2022-07-15"]:
+        var = json.loads((tmp_path / "build" / date / "index.json").read_text())
+        assert var["date"] == date and var["n_genomes"] == 2
+        assert (tmp_path / "data" / "genomics" / f"{date}.csv").exists()
+    assert var["file"] == links[-1]
+    # yesterday's counts, and last week's stored when first compared against
+    assert aggregates.history().index.day.tolist() == [6, 7, 8, 12, 13, 14]
+
+
+def test_trends_missing_days():
+    # Friday is carried over the weekend, but not over missing weekdays
+    history = pd.DataFrame(
+        {"Spain": [10, 20, 30]},
+        index=pd.to_datetime(["2022-07-01", "2022-07-11", "2022-07-15"]),
+    )
+    trend = build.trends(history, datetime.date(2022, 7, 15), horizons=[4, 7, 14])
+    assert trend.loc["Spain", "Diff_4d"] == 10  # from Monday 11th
+    assert pd.isna(trend.loc["Spain", "Diff_7d"])  # Friday 8th is missing
+    assert trend.loc["Spain", "Diff_14d"] == 20
+    assert set(build.trend_variables(trend)) >= {
+        "n_diff_confirmed_4d",
+        "pc_diff_confirmed_14d",
+    }
+
+
+def test_trends():
+    history = pd.DataFrame(
+        {"Spain": [10, 20, 30, 60], "Peru": [0, 0, 5, 5]},
+        index=pd.to_datetime(["2022-06-24", "2022-07-01", "2022-07-08", "2022-07-15"]),
+    )
+    trend = build.trends(history, datetime.date(2022, 7, 15), horizons=[7, 14, 28])
+    assert trend.Cases.to_dict() == {"Spain": 60, "Peru": 5, "Total": 65}
+    assert trend.Diff_7d.to_dict() == {"Spain": 30, "Peru": 0, "Total": 30}
+    assert trend.loc["Spain", "Pc_diff_14d"] == 200
+    assert pd.isna(trend.loc["Peru", "Pc_diff_14d"])  # no cases 14 days ago
+    assert pd.isna(trend.loc["Spain", "Diff_28d"])  # no data 28 days ago
+    assert trend.loc["Spain", "Avg_daily"] == 30 / 7
+    assert trend.loc["Spain", "Growth"] == 200
+    assert build.trends(history, datetime.date(2022, 7, 16)) is None
+
+    var = build.trend_variables(trend)
+    assert var["n_diff_confirmed_7d"] == 30
+    assert var["pc_diff_confirmed_7d"] == 85.7
+    assert var["n_diff_confirmed_28d"] is None
+    assert var["growth_confirmed"] == 100  # 30 cases after 15
+    html = build.table_confirmed_cases(
+        pd.DataFrame(
+            {"Status": ["confirmed"] * 3, "Country": ["Spain", "Spain", "Peru"]}
+        ),
+        pd.DataFrame({"Status": ["confirmed"] * 2, "Country": ["Spain", "Peru"]}),
+        trend,
+    )["embed_table_confirmed_cases"]
+    assert "% difference compared to 14 days ago" in html
+    assert "% difference compared to 7 days ago" not in html
+    assert build.TREND_AVERAGE_COLUMN in html
+
+
+def test_stages():
+    order = []
+
+    def stage(name, value):
+        def func(*args):
+            order.append(name)
+            return value + sum(args)
+
+        return func
+
+    build_stages = [
+        stages.Stage("sum", stage("sum", 0), inputs=["a", "b"], after=["c"]),
+        stages.Stage("a", stage("a", 1)),
+        stages.Stage("b", stage("b", 2), inputs=["a"]),
+        stages.Stage("c", stage("c", 0)),
+    ]
+    results, timings = stages.run(build_stages)
+    assert results == {"a": 1, "b": 3, "c": 0, "sum": 4}
+    assert order.index("a") < order.index("b") < order.index("sum")
+    assert timings["b"][0] >= timings["a"][1]
+    assert stages.critical_path(build_stages, timings)[-1] == "sum"
+
+    with pytest.raises(ValueError, match="Cycle"):
+        stages.check([stages.Stage("a", int, ["b"]), stages.Stage("b", int, ["a"])])
+    with pytest.raises(ValueError, match="unknown"):
+        stages.check([stages.Stage("a", int, ["b"])])
+    with pytest.raises(ZeroDivisionError):
+        stages.run([stages.Stage("a", lambda: 1 / 0), stages.Stage("b", int, ["a"])])
+
+
+def test_stages_instrumented(tmp_path):
+    instrument.start(trace_memory=True, profile=True)
+    try:
+        results, _ = stages.run(
+            [
+                stages.Stage("thread", lambda: [0] * 1000),
+                stages.Stage("process", sum, ["thread"], process=True),
+            ]
+        )
+        spans = {s["name"]: s for s in instrument.spans()}
+        assert results["process"] == 0
+        assert spans.keys() == {"stage/thread", "stage/process"}
+        # tracemalloc peaks are only recorded in the main thread of a process
+        assert "peak_traced_bytes" in spans["stage/process"]
+        assert "peak_traced_bytes" not in spans["stage/thread"]
+        assert instrument.write_profile(tmp_path / "build.prof")
+        stats = pstats.Stats(str(tmp_path / "build.prof"))
+        assert any("builtins.sum" in name for _, _, name in stats.stats)
+    finally:
+        tracemalloc.stop()
+        instrument.start()
+
+
+def test_stages_cache(tmp_path):
+    calls = []
+    template, output = tmp_path / "template.txt", tmp_path / "output.txt"
+    template.write_text("Cases: {}")
+
+    def run(data):
+        def render(n):
+            calls.append("render")
+            output.write_text(template.read_text().format(n))
+            return n
+
+        return stages.run(
+            [
+                stages.Stage("data", lambda: data, volatile=True),
+                stages.Stage(
+                    "count", lambda d: calls.append("count") or len(d), ["data"]
+                ),
+                stages.Stage(
+                    "render",
+                    render,
+                    inputs=["count"],
+                    fingerprint=[template],
+                    cache=True,
+                    outputs=[output],
+                ),
+            ],
+            cache_path=tmp_path / "stages",
+        )[0]
+
+    assert run([1, 2])["render"] == 2
+    output.unlink()
+    assert "render" not in run([1, 2])  # cached and not taken, output restored
+    assert calls == ["count", "render", "count"]
+    assert output.read_text() == "Cases: 2"
+    template.write_text("Confirmed: {}")
+    run([1, 2])
+    run([1, 2, 3])
+    assert calls[3:] == ["count", "render", "count", "render"]
+    assert output.read_text() == "Confirmed: 3"
+    assert stages.digest(pd.DataFrame({"a": [1]})) != stages.digest(
+        pd.DataFrame({"b": [1]})
+    )
+
+
+def test_stages_cache_loaded_when_taken(tmp_path):
+    calls = []
+
+    def run(suffix):
+        return stages.run(
+            [
+                stages.Stage(
+                    "summary", lambda: calls.append("summary") or {"n": 2}, cache=True
+                ),
+                stages.Stage(
+                    "render",
+                    lambda summary: calls.append("render") or f"{summary['n']}{suffix}",
+                    inputs=["summary"],
+                    fingerprint=[suffix],
+                    cache=True,
+                ),
+            ],
+            cache_path=tmp_path / "stages",
+        )[0]
+
+    assert run("!") == {"summary": {"n": 2}, "render": "2!"}
+    assert run("!") == {}  # neither result is taken
+    assert run("?") == {"summary": {"n": 2}, "render": "2?"}
+    assert calls == ["summary", "render", "render"]
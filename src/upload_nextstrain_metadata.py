@@ -1,17 +1,36 @@
+"""
+Fetch Nextstrain metadata and upload it to the Monkeypox bucket
+
+The metadata is compressed while it is uploaded, and if it has not changed
+since the latest upload, only a pointer to the latest upload is written.
+"""
+import io
 import os
+import json
+import zlib
+import hashlib
 import logging
 from typing import Optional
 from pathlib import Path
 from datetime import datetime
 
 import boto3
-from selenium import webdriver
-from selenium.webdriver.common.by import By
+
+from nextstrain_keys import (
+    NEXTSTRAIN_FILE,
+    NEXTSTRAIN_COMPRESSED_FILE,
+    NEXTSTRAIN_POINTER_FILE,
+    NEXTSTRAIN_LATEST_KEY,
+)
 
 NEXTSTRAIN_MPXV = "https://nextstrain.org/monkeypox/hmpxv1"
+CHUNK_SIZE = 1 << 20
 
 
 def fetch_metadata(link: str) -> Optional[Path]:
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+
     options = webdriver.FirefoxOptions()
     options.headless = True
     driver = webdriver.Firefox(options=options)
@@ -30,26 +49,94 @@ def fetch_metadata(link: str) -> Optional[Path]:
 
     find_button("DOWNLOAD DATA").click()
     find_button("METADATA (TSV)").click()
-    if (
-        file := Path.home() / "Downloads" / "nextstrain_monkeypox_hmpxv1_metadata.tsv"
-    ).exists():
+    if (file := Path.home() / "Downloads" / NEXTSTRAIN_FILE).exists():
         return file
     return None
 
 
+class GzipReader(io.RawIOBase):
+    "Readable stream of gzip compressed contents of a file, compressed as read"
+
+    def __init__(self, file: Path):
+        self.file = file.open("rb")
+        self.compressor = zlib.compressobj(wbits=31)  # gzip container
+        self.buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self.compressor and len(self.buffer) < len(b):
+            if chunk := self.file.read(CHUNK_SIZE):
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.compressor = None
+        n = min(len(b), len(self.buffer))
+        b[:n], self.buffer = self.buffer[:n], self.buffer[n:]
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def checksum(file: Path) -> str:
+    sha = hashlib.sha256()
+    with file.open("rb") as fp:
+        while chunk := fp.read(CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def latest(s3, bucket: str) -> Optional[dict[str, str]]:
+    "Return key and checksum of latest compressed upload, None if not found"
+    try:
+        return json.load(
+            s3.get_object(Bucket=bucket, Key=NEXTSTRAIN_LATEST_KEY)["Body"]
+        )
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
 def upload(file: Path):
     if file is None:
         logging.error("Nextstrain file not downloaded")
         return None
     if not (BUCKET := os.getenv("MONKEYPOX_BUCKET")):
         raise ValueError("Specify bucket to copy files to in MONKEYPOX_BUCKET")
-    s3 = boto3.resource("s3")
+    s3 = boto3.client("s3")
     today = datetime.today().date()
     try:
-        s3.Object(BUCKET, f"{today}/nextstrain_monkeypox_hmpxv1_metadata.tsv").put(
-            Body=file.read_text()
+        sha256 = checksum(file)
+        if (previous := latest(s3, BUCKET)) and previous["sha256"] == sha256:
+            logging.info(f"Nextstrain metadata unchanged since {previous['key']}")
+            s3.put_object(
+                Bucket=BUCKET,
+                Key=f"{today}/{NEXTSTRAIN_POINTER_FILE}",
+                Body=json.dumps(previous),
+                ContentType="application/json",
+            )
+            return
+        key = f"{today}/{NEXTSTRAIN_COMPRESSED_FILE}"
+        with GzipReader(file) as body:
+            # uploaded in parts as the file is compressed
+            s3.upload_fileobj(
+                body,
+                BUCKET,
+                key,
+                ExtraArgs={
+                    "ContentType": "application/gzip",
+                    "Metadata": {"sha256": sha256},
+                },
+            )
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=NEXTSTRAIN_LATEST_KEY,
+            Body=json.dumps({"key": key, "sha256": sha256}),
+            ContentType="application/json",
         )
-    except Exception as exc:
+    except Exception:
         logging.exception("Failed to upload Nextstrain metadata")
         raise
 